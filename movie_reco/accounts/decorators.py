@@ -1,29 +1,36 @@
 from django.shortcuts import redirect
 from .models import User
+from .utils import get_user_obj, is_valid_user
 
 
 def login_required(function):
     def wrap(request, *args, **kwargs):
-        user = request.session.get('user')
-        if user is None or not user:
+        if not is_valid_user(request):
             return redirect('index')
-        try:
-            User.objects.get(id=user)
-        except User.DoesNotExist:
+        return function(request, *args, **kwargs)
+    return wrap
+
+
+def user_required(function):
+    '''
+    login_required for the views that use the user object: the fast path of login_required lets a deleted user
+    through for a while, so the user is loaded (once per request) and checked here instead.
+    '''
+    def wrap(request, *args, **kwargs):
+        if get_user_obj(request) is None:
             return redirect('index')
-        else:
-            return function(request, *args, **kwargs)
+        return function(request, *args, **kwargs)
     return wrap
 
 
 def admin_required(function):
     def wrap(request, *args, **kwargs):
-        user = request.session.get('user')
+        user = get_user_obj(request)
 
-        if user is None or not user:
+        if user is None:
             return redirect('index')
 
-        if User.objects.get(id=user).type != User.ADMIN:
+        if user.type != User.ADMIN:
             return redirect('home')
         return function(request, *args, **kwargs)
 
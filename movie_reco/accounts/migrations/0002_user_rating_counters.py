@@ -0,0 +1,33 @@
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_rating_counters(apps, schema_editor):
+    User = apps.get_model('accounts', 'User')
+    users = list(User.objects.annotate(n_ratings=Count('ratings')))
+    for user in users:
+        user.rating_count = user.n_ratings
+        user.rating_version = user.n_ratings
+    User.objects.bulk_update(users, ['rating_count', 'rating_version'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+        ('ratings', '0002_auto_20200216_1743'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='rating_count',
+            field=models.IntegerField(default=0, verbose_name='# of ratings'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='rating_version',
+            field=models.IntegerField(default=0, verbose_name='Rating set version'),
+        ),
+        migrations.RunPython(backfill_rating_counters, migrations.RunPython.noop),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models import F
 
 
 class User(models.Model):
@@ -13,7 +14,18 @@ class User(models.Model):
             (USER, 'user'),
             (BOT, 'bot')
         ))
+    # maintained by rating_changed, so that views don't have to count the ratings table
+    rating_count = models.IntegerField(default=0, verbose_name="# of ratings")
+    rating_version = models.IntegerField(default=0, verbose_name="Rating set version")
 
     def __str__(self):
         return self.email
 
+    def rating_changed(self, count_delta=0):
+        '''
+        Call in the transaction of every rating write: adjusts the count and bumps the version.
+        '''
+        User.objects.filter(id=self.id).update(rating_count=F('rating_count') + count_delta,
+                                               rating_version=F('rating_version') + 1)
+        self.refresh_from_db(fields=['rating_count', 'rating_version'])
+
@@ -1,19 +1,59 @@
+import time
+
 from accounts.models import User
 from django.utils.crypto import get_random_string
 
+VALID_USER_TTL = 60  # seconds
+MAX_VALID_USERS = 10000
 
-def get_user_obj(request):
+# user id -> time until which it is known to exist
+_valid_user_ids = {}
+
+
+def _load_user(request):
     user_id = request.session.get('user')
     if user_id is None:
         return None
     try:
         user = User.objects.get(id=user_id)
     except User.DoesNotExist:
+        _valid_user_ids.pop(user_id, None)
         return None
     else:
+        _mark_valid(user.id)
         return user
 
 
+def _mark_valid(user_id):
+    if len(_valid_user_ids) >= MAX_VALID_USERS:
+        _valid_user_ids.clear()
+    _valid_user_ids[user_id] = time.monotonic() + VALID_USER_TTL
+
+
+def get_user_obj(request):
+    '''
+    Returns the logged-in user (or None). It is loaded at most once per request and kept on the request.
+    '''
+    # a DRF request wraps the HttpRequest the decorators see
+    request = getattr(request, '_request', request)
+    if not hasattr(request, '_user_obj'):
+        request._user_obj = _load_user(request)
+    return request._user_obj
+
+
+def is_valid_user(request):
+    '''
+    Whether the session belongs to an existing user, without loading it if it was seen in the last VALID_USER_TTL
+    seconds. Deleted users may pass for that long, so views that use the user object go through user_required.
+    '''
+    user_id = request.session.get('user')
+    if not user_id:
+        return False
+    if _valid_user_ids.get(user_id, 0) > time.monotonic():
+        return True
+    return get_user_obj(request) is not None
+
+
 def generate_random_email(length):
     return get_random_string(length) + "@random.user"
 
@@ -1,6 +1,6 @@
 from django.shortcuts import render, redirect
 from accounts.utils import get_user_obj
-from accounts.decorators import login_required
+from accounts.decorators import login_required, user_required
 
 
 def index(request):
@@ -11,10 +11,10 @@ def index(request):
         return redirect('home')
 
 
-@login_required
+@user_required
 def home(request):
     user = get_user_obj(request)
-    if user.ratings.all().count() < 10:
+    if user.rating_count < 10:
         return redirect('evaluate')
     return render(request, 'home.html', {'user': user.email})
 
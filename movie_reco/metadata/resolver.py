@@ -0,0 +1,63 @@
+import threading
+
+from django.db import transaction
+
+from .models import Country, Language, Genre, Company
+
+
+class MetadataResolver:
+    """
+    In-process lookup of the small metadata tables, so that TMDB entries can be matched without a query per entry.
+    Genres, languages and countries are loaded once; companies TMDB returns that we don't have yet are created.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def _load(self):
+        with self._lock:
+            if self._loaded:
+                return
+            self.genre_ids = set(Genre.objects.values_list('id', flat=True))
+            self.language_ids = dict(Language.objects.values_list('code', 'id'))
+            self.country_ids = dict(Country.objects.values_list('code', 'id'))
+            self.company_ids = set(Company.objects.values_list('id', flat=True))
+            self._loaded = True
+
+    def reset(self):
+        with self._lock:
+            self._loaded = False
+
+    def resolve(self, data):
+        '''
+        Returns the ids of the known genres, languages, countries and companies of one TMDB movie entry.
+        Entries missing from our tables are left out, except for companies (see create_companies).
+        '''
+        self._load()
+        return {
+            'genres': {entry['id'] for entry in data['genres'] if entry['id'] in self.genre_ids},
+            'languages': {self.language_ids[entry['iso_639_1']] for entry in data['spoken_languages']
+                          if entry['iso_639_1'] in self.language_ids},
+            'countries': {self.country_ids[entry['iso_3166_1']] for entry in data['production_countries']
+                          if entry['iso_3166_1'] in self.country_ids},
+            'companies': {entry['id'] for entry in data['production_companies']},
+        }
+
+    def create_companies(self, entries):
+        '''
+        Inserts the companies among the TMDB entries that aren't in the table yet, with a single query.
+        '''
+        self._load()
+        new_companies = {entry['id']: Company(id=entry['id'], name=entry['name'])
+                         for entry in entries if entry['id'] not in self.company_ids}
+        if new_companies:
+            Company.objects.bulk_create(new_companies.values(), ignore_conflicts=True)
+            transaction.on_commit(lambda: self._add_companies(new_companies.keys()))
+
+    def _add_companies(self, company_ids):
+        with self._lock:
+            self.company_ids.update(company_ids)
+
+
+METADATA_RESOLVER = MetadataResolver()
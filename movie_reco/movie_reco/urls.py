@@ -17,9 +17,9 @@ from django.contrib import admin
 from django.urls import path
 from core.views import index, about, home
 from accounts.views import LoginView, RegisterView, logout, guest_login
-from ratings.views import evaluate, my_ratings, RatingAPI
-from movies.views import MovieAPI, SimpleMovieAPI
-from recommender.views import RecoListAPI
+from ratings.views import evaluate, my_ratings, RatingAPI, RatingBatchAPI
+from movies.views import MovieAPI, SimpleMovieAPI, SimpleMovieBatchAPI
+from recommender.views import RecoListAPI, reco_metrics
 
 api_base_urls = [
     path('evaluate/', evaluate, name='evaluate'),
@@ -29,8 +29,10 @@ api_base_urls = [
 
 api_urls = [
     path('evaluate/<int:movie_id>/', RatingAPI.as_view()),
+    path('evaluate/batch/', RatingBatchAPI.as_view()),
     path('movie/<int:movie_id>/', MovieAPI.as_view()),
     path('movie/<int:movie_id>/lite/', SimpleMovieAPI.as_view()),
+    path('movie/batch/', SimpleMovieBatchAPI.as_view()),
     path('recommendation/<int:limit>/', RecoListAPI.as_view()),
 ]
 
@@ -44,4 +46,5 @@ urlpatterns = [
     path('logout/', logout, name='logout'),
     path('register/', RegisterView.as_view(), name='register'),
     path('evaluate/record/', my_ratings, name='eval_record'),
+    path('metrics/', reco_metrics, name='metrics'),
 ] + api_base_urls + api_urls
\ No newline at end of file
@@ -0,0 +1,114 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import requests
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from movies.exceptions import UpdateFailed
+from movies.models import Movie, save_tmdb_relations, invalidate_detail_cache
+from movies.tmdb import make_session, TokenBucket
+
+UPDATE_FIELDS = ['title_kr', 'release_date', 'tagline', 'overview_kr', 'is_init_state',
+                 'poster', 'tmdb_score', 'tmdb_votes', 'tmdb_popularity', 'use_alt_poster', 'last_update']
+
+
+class Command(BaseCommand):
+    help = "Refreshes stale movies (or the given ones) from the TMDB API, several at a time"
+
+    def add_arguments(self, parser):
+        parser.add_argument('movie_ids', nargs='*', type=int, help="movies to refresh (default: all stale movies)")
+        parser.add_argument('--days', type=int, default=1, help="refresh movies last updated at least this long ago")
+        parser.add_argument('--init-only', action='store_true', help="only refresh movies in their initial state")
+        parser.add_argument('--force', action='store_true', help="overwrite the descriptive fields of every movie")
+        parser.add_argument('--workers', type=int, default=8, help="number of concurrent API calls")
+        parser.add_argument('--rate', type=float, default=20, help="max. API calls per second")
+        parser.add_argument('--batch-size', type=int, default=100, help="number of movies saved per transaction")
+        parser.add_argument('--checkpoint', default="tmdb_sync.json", help="progress file")
+        parser.add_argument('--resume', action='store_true', help="skip the movies done in the last run")
+
+    def _get_queryset(self, options):
+        movies = Movie.objects.order_by('id')
+        if options['movie_ids']:
+            return movies.filter(id__in=options['movie_ids'])
+        if options['init_only']:
+            return movies.filter(is_init_state=True)
+        if options['force']:
+            return movies
+        threshold = datetime.now(timezone.utc) - timedelta(days=options['days'])
+        return movies.filter(Q(is_init_state=True) | Q(last_update__lte=threshold))
+
+    def _read_checkpoint(self, path):
+        if not os.path.isfile(path):
+            return {'last_id': 0, 'failed': []}
+        with open(path) as f:
+            return json.load(f)
+
+    def _write_checkpoint(self, path, checkpoint):
+        with open(path + ".tmp", "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(path + ".tmp", path)
+
+    def _apply(self, movies, results, force_update):
+        '''
+        Saves one batch in a single transaction: one bulk update for the movies, and a few queries per relation
+        table for the genres etc. of the movies that need them. Returns the ids of the movies that failed.
+        '''
+        now = datetime.now(timezone.utc)
+        updated, relations, failed = [], [], []
+        for movie, data in zip(movies, results):
+            if data is None:
+                failed.append(movie.id)
+                continue
+            try:
+                if movie.apply_tmdb_data(data, force_update, commit=False):
+                    relations.append((movie, data))
+            except (KeyError, TypeError) as e:
+                self.stderr.write(f"Unexpected data for {movie.title} ({movie.id}): {e!r}")
+                failed.append(movie.id)
+            else:
+                movie.last_update = now
+                updated.append(movie)
+
+        with transaction.atomic():
+            save_tmdb_relations(relations)
+            Movie.objects.bulk_update(updated, UPDATE_FIELDS)
+            invalidate_detail_cache([movie.id for movie in updated])
+        return failed
+
+    def handle(self, *args, **options):
+        checkpoint_path = options['checkpoint']
+        checkpoint = self._read_checkpoint(checkpoint_path) if options['resume'] else {'last_id': 0, 'failed': []}
+
+        movies = list(self._get_queryset(options).filter(id__gt=checkpoint['last_id']))
+        self.stdout.write(f"Refreshing {len(movies)} movies...")
+
+        session = make_session(pool_size=options['workers'])
+        bucket = TokenBucket(options['rate'])
+
+        def fetch(movie):
+            bucket.acquire()
+            try:
+                return movie.fetch_from_tmdb(session)
+            except (UpdateFailed, requests.RequestException, ValueError):
+                return None
+
+        batch_size = options['batch_size']
+        n_done = 0
+        with ThreadPoolExecutor(options['workers']) as executor:
+            for start in range(0, len(movies), batch_size):
+                batch = movies[start:start + batch_size]
+                results = list(executor.map(fetch, batch))
+                failed = self._apply(batch, results, options['force'])
+
+                checkpoint['last_id'] = batch[-1].id
+                checkpoint['failed'] += failed
+                self._write_checkpoint(checkpoint_path, checkpoint)
+                n_done += len(batch)
+                self.stdout.write(f"{n_done}/{len(movies)} movies done, {len(checkpoint['failed'])} failed")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Done. {len(checkpoint['failed'])} movies failed and stay stale; they are retried on the next run."))
@@ -1,11 +1,24 @@
 from datetime import datetime, timezone
 
 import requests
-from django.db import models
+from django.core.cache import cache
+from django.db import models, transaction
 
-from metadata.models import Country, Language, Company, Genre
+from metadata.resolver import METADATA_RESOLVER
 from .exceptions import UpdateFailed
-from .tmdb import api_url
+from .tmdb import api_url, api_timeout
+
+DETAIL_CACHE_TIMEOUT = 600  # seconds
+
+
+def detail_cache_key(movie_id):
+    return f"movie_detail:{movie_id}"
+
+
+def invalidate_detail_cache(movie_ids):
+    # after the commit, so that a concurrent request can't cache the old rows again in between
+    keys = [detail_cache_key(movie_id) for movie_id in movie_ids]
+    transaction.on_commit(lambda: cache.delete_many(keys))
 
 
 class Movie(models.Model):
@@ -40,55 +53,37 @@ class Movie(models.Model):
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        invalidate_detail_cache([self.id])
+
     def is_older_than(self, days: int):
         return (datetime.now(timezone.utc) - self.last_update).days >= days
 
-    def update_from_tmdb(self, force_update=False):
-        response = requests.get(api_url(self.tmdb_id))
+    def fetch_from_tmdb(self, session=requests):
+        response = session.get(api_url(self.tmdb_id), timeout=api_timeout)
 
         if not response.ok:
             raise UpdateFailed
 
-        data = response.json()
+        return response.json()
 
-        if self.is_init_state or force_update:
+    def update_from_tmdb(self, force_update=False):
+        self.apply_tmdb_data(self.fetch_from_tmdb(), force_update)
+
+    def apply_tmdb_data(self, data, force_update=False, commit=True):
+        '''
+        Copies the TMDB data onto the movie. Returns whether its genres, languages etc. have to be saved as well.
+        With commit=False nothing is written, so that many movies can be saved at once (see save_tmdb_relations).
+        '''
+        update_relations = self.is_init_state or force_update
+        if update_relations:
             self.title_kr = data['title']
             self.release_date = data['release_date']
 
             self.tagline = data['tagline']
             self.overview_kr = data['overview']
 
-            # delete initial movie_genre data
-            MovieGenre.objects.filter(movie=self).all().delete()
-            for entry in data['genres']:
-                genre = Genre.objects.get(id=entry['id'])
-                MovieGenre.objects.get_or_create(movie=self, genre=genre)
-
-            for entry in data['spoken_languages']:
-                try:
-                    language = Language.objects.get(code=entry['iso_639_1'])
-                except Language.DoesNotExist:
-                    continue
-                else:
-                    MovieLanguage.objects.get_or_create(movie=self, language=language)
-
-            for entry in data['production_countries']:
-                try:
-                    country = Country.objects.get(code=entry['iso_3166_1'])
-                except Country.DoesNotExist:
-                    continue
-                else:
-                    MovieCountry.objects.get_or_create(movie=self, country=country)
-
-            for entry in data['production_companies']:
-                try:
-                    company = Company.objects.get(id=entry['id'])
-                except Company.DoesNotExist:
-                    company = Company(id=entry['id'], name=entry['name'])
-                    company.save()
-                finally:
-                    MovieCompany.objects.get_or_create(movie=self, company=company)
-
             self.is_init_state = False
 
         self.poster = data['poster_path']
@@ -99,7 +94,12 @@ class Movie(models.Model):
         if self.overview_kr:
             self.use_alt_poster = False
 
-        self.save()
+        if commit:
+            with transaction.atomic():
+                if update_relations:
+                    save_tmdb_relations([(self, data)])
+                self.save()
+        return update_relations
 
 
 class MovieLanguage(models.Model):
@@ -183,4 +183,36 @@ class MovieDirector(models.Model):
     class Meta:
         constraints = [
             models.UniqueConstraint(fields=['movie', 'director'], name='Movie director')
-        ]
\ No newline at end of file
+        ]
+
+
+def _sync_relations(model, field, movie_ids, targets, replace):
+    existing = model.objects.filter(movie_id__in=movie_ids).values_list('id', 'movie_id', field)
+    existing_pairs = set()
+    stale = []
+    for row_id, movie_id, target_id in existing:
+        if target_id in targets[movie_id]:
+            existing_pairs.add((movie_id, target_id))
+        elif replace:
+            stale.append(row_id)
+    if stale:
+        model.objects.filter(id__in=stale).delete()
+    model.objects.bulk_create([model(movie_id=movie_id, **{field: target_id})
+                               for movie_id in movie_ids for target_id in targets[movie_id]
+                               if (movie_id, target_id) not in existing_pairs], ignore_conflicts=True)
+
+
+def save_tmdb_relations(movies_data):
+    '''
+    Saves the genres, languages, countries and companies of (movie, TMDB data) pairs with a few queries per table
+    for all movies together. Genres are replaced; the other relations are only added to.
+    '''
+    resolved = {movie.id: METADATA_RESOLVER.resolve(data) for movie, data in movies_data}
+    movie_ids = list(resolved.keys())
+    with transaction.atomic():
+        METADATA_RESOLVER.create_companies(entry for _, data in movies_data for entry in data['production_companies'])
+        for model, field, key, replace in ((MovieGenre, 'genre_id', 'genres', True),
+                                           (MovieLanguage, 'language_id', 'languages', False),
+                                           (MovieCountry, 'country_id', 'countries', False),
+                                           (MovieCompany, 'company_id', 'companies', False)):
+            _sync_relations(model, field, movie_ids, {movie_id: ids[key] for movie_id, ids in resolved.items()}, replace)
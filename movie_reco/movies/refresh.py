@@ -0,0 +1,112 @@
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.db import connection
+
+from .exceptions import UpdateFailed
+
+logger = logging.getLogger('movie_api')
+
+REFRESH_WORKERS = 4
+BASE_BACKOFF = 60  # seconds
+MAX_BACKOFF = 6 * 3600
+
+
+def needs_update(movie):
+    return movie.is_init_state or movie.is_older_than(1)
+
+
+class RefreshWorker:
+    """
+    Refreshes movies from TMDB on a local thread pool, so that requests are served from the stored rows right away.
+    A movie is refreshed by at most one thread at a time (single-flight), and after a failure it isn't
+    tried again until its backoff (doubled on every consecutive failure) runs out.
+    """
+
+    def __init__(self, max_workers=REFRESH_WORKERS, base_backoff=BASE_BACKOFF, max_backoff=MAX_BACKOFF):
+        self.max_workers = max_workers
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._in_flight = {}
+        self._failures = {}  # movie id -> (# of consecutive failures, retry time)
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="tmdb-refresh")
+        return self._executor
+
+    def is_backing_off(self, movie_id):
+        failure = self._failures.get(movie_id)
+        return failure is not None and failure[1] > time.monotonic()
+
+    def submit(self, movie):
+        '''
+        Enqueues a refresh of the movie unless it is fresh, already queued, or backing off.
+        Returns whether a refresh was enqueued.
+        '''
+        if not needs_update(movie):
+            return False
+        with self._lock:
+            if movie.id in self._in_flight or self.is_backing_off(movie.id):
+                return False
+            self._in_flight[movie.id] = self._get_executor().submit(self._refresh, movie.id)
+        return True
+
+    def submit_many(self, movies):
+        return sum(self.submit(movie) for movie in movies)
+
+    def wait(self, timeout=None):
+        '''
+        Blocks until the refreshes enqueued so far are done. Meant for tests and management commands.
+        '''
+        with self._lock:
+            futures = list(self._in_flight.values())
+        for future in futures:
+            future.exception(timeout)
+
+    def _backoff(self, n_failures):
+        backoff = min(self.base_backoff * 2 ** (n_failures - 1), self.max_backoff)
+        # jitter, so that movies that failed together aren't retried together
+        return backoff * random.uniform(0.5, 1.0)
+
+    def _refresh(self, movie_id):
+        from .models import Movie
+
+        try:
+            # the row may have been refreshed since the request that enqueued it read it
+            movie = Movie.objects.filter(id=movie_id).first()
+            if movie is None or not needs_update(movie):
+                return
+            movie.update_from_tmdb()
+        except (UpdateFailed, requests.RequestException) as e:
+            with self._lock:
+                n_failures = self._failures.get(movie_id, (0, 0))[0] + 1
+                backoff = self._backoff(n_failures)
+                self._failures[movie_id] = (n_failures, time.monotonic() + backoff)
+            logger.error(f"Couldn't get movie data from TMDB API: movie #{movie_id} ({e!r}), "
+                         f"retrying in {backoff:.0f}s")
+        except Exception:
+            logger.exception(f"Refresh failed: movie #{movie_id}")
+        else:
+            with self._lock:
+                self._failures.pop(movie_id, None)
+        finally:
+            with self._lock:
+                self._in_flight.pop(movie_id, None)
+            connection.close()
+
+
+REFRESH_WORKER = RefreshWorker()
+
+# threads don't survive a fork, so a forked worker process starts with an empty pool
+os.register_at_fork(after_in_child=REFRESH_WORKER._reset)
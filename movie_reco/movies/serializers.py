@@ -1,4 +1,6 @@
+from django.db.models import Prefetch
 from rest_framework.serializers import ModelSerializer
+
 from .models import Movie, MovieGenre, MovieCompany, MovieLanguage, MovieCountry, MovieActor, MovieDirector
 
 
@@ -78,6 +80,16 @@ class MovieSerializer(ModelSerializer):
             'genres', 'directors', 'actors', 'countries',
         ]
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        # one query per nested relation, instead of one per join row
+        return queryset.prefetch_related(
+            Prefetch('genres', queryset=MovieGenre.objects.select_related('genre')),
+            Prefetch('directors', queryset=MovieDirector.objects.select_related('director')),
+            Prefetch('actors', queryset=MovieActor.objects.select_related('actor')),
+            Prefetch('countries', queryset=MovieCountry.objects.select_related('country')),
+        )
+
 
 class SimpleMovieSerializer(ModelSerializer):
     class Meta:
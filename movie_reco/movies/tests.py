@@ -1,3 +1,90 @@
-from django.test import TestCase
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+from django.test import TransactionTestCase
+
+from .models import Movie
+from .refresh import RefreshWorker
+
+
+class FakeTMDB:
+    """
+    Local stand-in for the TMDB API that fails every request with the given status.
+    Responses are held back until release() is called.
+    """
+
+    def __init__(self, status=500):
+        self.status = status
+        self.requests = []
+        self.released = threading.Event()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake.requests.append(self.path)
+                fake.released.wait(5)
+                self.send_response(fake.status)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def api_base(self):
+        return f"http://127.0.0.1:{self.server.server_port}/movie/"
+
+    def release(self):
+        self.released.set()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class RefreshWorkerTest(TransactionTestCase):
+    def setUp(self):
+        self.movie = Movie.objects.create(tmdb_id=550, imdb_id="tt0137523", title="Fight Club", title_kr="",
+                                          tagline="", overview="", overview_kr="", alt_poster="")
+        self.worker = RefreshWorker(max_workers=4, base_backoff=0.2, max_backoff=0.2)
+
+    def test_single_flight(self):
+        with FakeTMDB() as tmdb, mock.patch('movies.tmdb.api_base', tmdb.api_base):
+            with self.assertLogs('movie_api', 'ERROR'):
+                self.assertTrue(self.worker.submit(self.movie))
+                # the refresh is still waiting for TMDB
+                self.assertFalse(self.worker.submit(self.movie))
+                self.assertEqual(self.worker.submit_many([self.movie] * 3), 0)
+                tmdb.release()
+                self.worker.wait(5)
+            self.assertEqual(len(tmdb.requests), 1)
+
+    def test_backoff_after_server_error(self):
+        with FakeTMDB(status=500) as tmdb, mock.patch('movies.tmdb.api_base', tmdb.api_base):
+            tmdb.release()
+            with self.assertLogs('movie_api', 'ERROR') as logs:
+                self.assertTrue(self.worker.submit(self.movie))
+                self.worker.wait(5)
+            self.assertIn("retrying in", logs.output[0])
+
+            self.assertTrue(self.worker.is_backing_off(self.movie.id))
+            self.assertFalse(self.worker.submit(self.movie))
+            self.assertEqual(len(tmdb.requests), 1)
+
+            # the backoff (0.1 to 0.2 s with jitter) runs out
+            time.sleep(0.25)
+            self.assertFalse(self.worker.is_backing_off(self.movie.id))
+            with self.assertLogs('movie_api', 'ERROR'):
+                self.assertTrue(self.worker.submit(self.movie))
+                self.worker.wait(5)
+            self.assertEqual(len(tmdb.requests), 2)
+            self.assertEqual(self.worker._failures[self.movie.id][0], 2)
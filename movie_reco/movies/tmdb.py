@@ -1,11 +1,20 @@
 import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
-api_base = "https://api.themoviedb.org/3/movie/"
+# can be pointed to a local fake server for testing
+api_root = os.environ.get('TMDB_API_ROOT', "https://api.themoviedb.org/3")
+api_base = api_root + "/movie/"
+api_timeout = 5  # seconds
 with open(os.path.join(BASE_DIR, 'keys/api_key.txt')) as f:
     api_key = f.read().strip()
-config_url = "https://api.themoviedb.org/3/configuration?api_key=" + api_key
+config_url = api_root + "/configuration?api_key=" + api_key
 poster_base = "https://image.tmdb.org/t/p/"
 
 
@@ -17,3 +26,42 @@ def api_url(movie_id):
 
 def poster_url(poster_path, size="w342"):
     return f"{poster_base}{size}{poster_path}"
+
+
+def make_session(pool_size=10, retries=5, backoff_factor=0.5):
+    '''
+    A session keeping up to pool_size connections to TMDB alive.
+    Rate-limited (429) and server error responses are retried with exponential backoff, honoring Retry-After.
+    '''
+    retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=(429, 500, 502, 503, 504),
+                  respect_retry_after_header=True, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: allows bursts of up to capacity calls and rate calls per second on average.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
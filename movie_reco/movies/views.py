@@ -1,5 +1,4 @@
-import logging
-
+from django.core.cache import cache
 from django.shortcuts import get_object_or_404
 from django.utils.decorators import method_decorator
 from rest_framework.renderers import JSONRenderer
@@ -9,31 +8,35 @@ from rest_framework.views import APIView
 from accounts.decorators import login_required
 from movies.tmdb import poster_url
 from recommender.reco_interface import RECO_INTERFACE
-from .exceptions import UpdateFailed
-from .models import Movie
+from .models import Movie, detail_cache_key, DETAIL_CACHE_TIMEOUT
+from .refresh import REFRESH_WORKER
 from .serializers import SimpleMovieSerializer, MovieSerializer
 
 
-logger = logging.getLogger('movie_api')
-
+def simple_movie_data(movie):
+    response_data = SimpleMovieSerializer(movie).data
 
-def run_update(movie):
-    try:
-        movie.update_from_tmdb()
-    except UpdateFailed:
-        logger.error(f"Couldn't get movie data from TMDB API: {movie.title} ({movie.release_year})")
+    if movie.use_alt_poster:
+        response_data['poster'] = movie.alt_poster
     else:
-        pass
+        response_data['poster'] = poster_url(movie.poster)
+
+    if not movie.overview_kr:
+        response_data['title_kr'], response_data['title'] = response_data['title'], response_data['title_kr']
+    return response_data
 
 
 @method_decorator(login_required, name='dispatch')
 class MovieAPI(APIView):
 
     def get(self, request, movie_id):
-        movie = get_object_or_404(Movie, id=movie_id)
+        # cached along with the version of the serving parameters its similar items come from
+        cached = cache.get(detail_cache_key(movie_id))
+        if cached is not None and cached[0] == RECO_INTERFACE.params_version:
+            return Response(cached[1])
 
-        if movie.is_init_state or movie.is_older_than(1):
-            run_update(movie)
+        movie = get_object_or_404(MovieSerializer.setup_eager_loading(Movie.objects.all()), id=movie_id)
+        REFRESH_WORKER.submit(movie)
 
         response_data = MovieSerializer(movie).data
 
@@ -50,6 +53,7 @@ class MovieAPI(APIView):
         response_data['similar_items'] = RECO_INTERFACE.get_similar_items(movie, 12)
 
         json = JSONRenderer().render(response_data)
+        cache.set(detail_cache_key(movie_id), (RECO_INTERFACE.params_version, json), DETAIL_CACHE_TIMEOUT)
         return Response(json)
 
 
@@ -57,19 +61,31 @@ class MovieAPI(APIView):
 class SimpleMovieAPI(APIView):
     def get(self, request, movie_id):
         movie = get_object_or_404(Movie, id=movie_id)
+        REFRESH_WORKER.submit(movie)
 
-        if movie.is_init_state or movie.is_older_than(1):
-            run_update(movie)
+        json = JSONRenderer().render(simple_movie_data(movie))
+        return Response(json)
 
-        response_data = SimpleMovieSerializer(movie).data
 
-        if movie.use_alt_poster:
-            response_data['poster'] = movie.alt_poster
-        else:
-            response_data['poster'] = poster_url(movie.poster)
-
-        if not movie.overview_kr:
-            response_data['title_kr'], response_data['title'] = response_data['title'], response_data['title_kr']
+@method_decorator(login_required, name='dispatch')
+class SimpleMovieBatchAPI(APIView):
+    """
+    Card data of several movies in one response: /movie/batch/?ids=1,2,3
+    Movies that don't exist are left out; stale ones are served as they are and refreshed afterwards.
+    """
+    MAX_BATCH_SIZE = 200
+
+    def get(self, request):
+        try:
+            movie_ids = [int(movie_id) for movie_id in request.GET.get('ids', '').split(',') if movie_id]
+        except ValueError:
+            return Response(status=400)
+        if len(movie_ids) > self.MAX_BATCH_SIZE:
+            return Response(status=400)
+
+        movies = Movie.objects.in_bulk(movie_ids)
+        response_data = [simple_movie_data(movies[movie_id]) for movie_id in movie_ids if movie_id in movies]
+        REFRESH_WORKER.submit_many(movies.values())
 
         json = JSONRenderer().render(response_data)
         return Response(json)
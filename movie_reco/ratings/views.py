@@ -1,43 +1,59 @@
+from django.db import IntegrityError, transaction
 from django.shortcuts import render
+from django.utils import timezone
 from django.utils.decorators import method_decorator
 from rest_framework.parsers import JSONParser
 from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from accounts.decorators import login_required
-from accounts.models import User
+from accounts.decorators import user_required
+from accounts.utils import get_user_obj
 from movies.models import Movie
 from .models import Rating
 from .serializers import RatingSerializer
+from recommender.cache import RECO_CACHE
 from recommender.reco_interface import RECO_INTERFACE
 
 
-@login_required
+def save_with_retry(save, attempts=3):
+    '''
+    Runs save (which reads the existing ratings, then writes them) in a transaction,
+    again if a concurrent write inserted one of the ratings in between.
+    '''
+    for attempt in range(attempts):
+        try:
+            with transaction.atomic():
+                return save()
+        except IntegrityError:
+            if attempt == attempts - 1:
+                raise
+
+
+@user_required
 def evaluate(request):
-    user = User.objects.get(id=request.session.get('user'))
+    user = get_user_obj(request)
     eval_list = RECO_INTERFACE.get_eval_list(user, limit=200)
     json = JSONRenderer().render(eval_list)
-    rating_count = user.ratings.all().count()
-    return render(request, 'evaluate.html', {'rating_count': rating_count, 'eval_list': json.decode('utf8')})
+    return render(request, 'evaluate.html', {'rating_count': user.rating_count, 'eval_list': json.decode('utf8')})
 
 
-@login_required
+@user_required
 def my_ratings(request):
-    user = User.objects.get(id=request.session.get('user'))
+    user = get_user_obj(request)
     serialized_data = RatingSerializer(user.ratings.all(), many=True).data
     json = JSONRenderer().render(serialized_data)
     return render(request, 'eval_record.html',
-                  {'rating_count': user.ratings.all().count(), 'record': json.decode('utf8')})
+                  {'rating_count': user.rating_count, 'record': json.decode('utf8')})
 
 
-@method_decorator(login_required, name='dispatch')
+@method_decorator(user_required, name='dispatch')
 class RatingAPI(APIView):
     parser_classes = [JSONParser]
 
-    def rating_to_json(self, obj):
+    def rating_to_json(self, obj, user):
         serialized_data = RatingSerializer(obj).data
-        serialized_data['rating_count'] = obj.user.ratings.count()
+        serialized_data['rating_count'] = user.rating_count
         return JSONRenderer().render(serialized_data)
 
     def get(self, request, movie_id):
@@ -47,7 +63,7 @@ class RatingAPI(APIView):
         except Rating.DoesNotExist:
             return Response(status=404)
         else:
-            json = self.rating_to_json(rating)
+            json = self.rating_to_json(rating, get_user_obj(request))
             return Response(json)
 
     def post(self, request, movie_id):
@@ -66,19 +82,28 @@ class RatingAPI(APIView):
         except Movie.DoesNotExist:
             return Response(status=404)
 
-        user_id = request.session.get('user')
-        user = User.objects.get(id=user_id)
-
-        try:
-            rating = Rating.objects.get(user=user, movie=movie)
-        except Rating.DoesNotExist:
-            rating = Rating.objects.create(user=user, movie=movie, score=score)
-        else:
-            if rating.score != score:
-                rating.score = score
-                rating.save()
-
-        json = self.rating_to_json(rating)
+        user = get_user_obj(request)
+
+        def save():
+            try:
+                rating = Rating.objects.get(user=user, movie=movie)
+            except Rating.DoesNotExist:
+                rating = Rating.objects.create(user=user, movie=movie, score=score)
+                user.rating_changed(1)
+                RECO_INTERFACE.save_predictions(user, [(movie.id, None, score)])
+            else:
+                if rating.score != score:
+                    old_score = rating.score
+                    rating.score = score
+                    rating.save()
+                    user.rating_changed()
+                    RECO_INTERFACE.save_predictions(user, [(movie.id, old_score, score)])
+            return rating
+
+        rating = save_with_retry(save)
+        RECO_CACHE.invalidate(user.id)
+
+        json = self.rating_to_json(rating, user)
         return Response(json)
 
     def delete(self, request, movie_id):
@@ -87,17 +112,95 @@ class RatingAPI(APIView):
         except Movie.DoesNotExist:
             return Response(status=204)
 
-        user_id = request.session.get('user')
-        user = User.objects.get(id=user_id)
+        user = get_user_obj(request)
+
+        def delete():
+            rating = Rating.objects.filter(user=user, movie=movie).first()
+            # a concurrent delete may have removed it meanwhile
+            if rating is None or not Rating.objects.filter(id=rating.id).delete()[0]:
+                return False
+            user.rating_changed(-1)
+            RECO_INTERFACE.save_predictions(user, [(movie.id, rating.score, None)])
+            return True
+
+        if save_with_retry(delete):
+            RECO_CACHE.invalidate(user.id)
+
+        empty_rating = Rating(user=user, movie=movie, score=None)
+        json = self.rating_to_json(empty_rating, user)
+        return Response(json)
+
 
+@method_decorator(user_required, name='dispatch')
+class RatingBatchAPI(APIView):
+    """
+    Saves many ratings in one transaction.
+    POST /evaluate/batch/ {"ratings": [{"movie": 1, "score": 4.5}, {"movie": 2, "score": null}, ...]}
+    A null score deletes the rating. Nothing is saved unless every entry is valid.
+    """
+    parser_classes = [JSONParser]
+    MAX_BATCH_SIZE = 200
+
+    def _parse(self, data):
+        scores = {}
+        for entry in data['ratings']:
+            movie_id, score = int(entry['movie']), entry['score']
+            if score is not None and score not in Rating.VALID_SCORES:
+                raise ValueError
+            scores[movie_id] = score
+        return scores
+
+    def post(self, request):
         try:
-            rating = Rating.objects.get(user=user, movie=movie)
-        except Rating.DoesNotExist:
-            pass
-        else:
-            rating.delete()
-        finally:
-            empty_rating = Rating(user=user, movie=movie, score=None)
-            json = self.rating_to_json(empty_rating)
-            return Response(json)
+            scores = self._parse(request.data)
+        except (KeyError, TypeError, ValueError):
+            return Response(status=400)
+        if len(scores) > self.MAX_BATCH_SIZE:
+            return Response(status=400)
 
+        if Movie.objects.filter(id__in=scores.keys()).count() != len(scores):
+            return Response(status=404)
+
+        user = get_user_obj(request)
+        changes = save_with_retry(lambda: self._save(user, scores))
+        if changes:
+            RECO_CACHE.invalidate(user.id)
+
+        response_data = {
+            'ratings': [{'movie': movie_id, 'score': score} for movie_id, score in scores.items()],
+            'rating_count': user.rating_count,
+        }
+        json = JSONRenderer().render(response_data)
+        return Response(json)
+
+    def _save(self, user, scores):
+        '''
+        Applies the scores and returns the (movie id, old score, new score) of every rating that changed.
+        '''
+        now = timezone.now()
+        existing = {rating.movie_id: rating for rating in Rating.objects.filter(user=user, movie_id__in=scores.keys())}
+        new_ratings, updated_ratings, deleted_ids = [], [], []
+        changes = []
+        for movie_id, score in scores.items():
+            rating = existing.get(movie_id)
+            if score is None:
+                if rating is not None:
+                    deleted_ids.append(rating.id)
+                    changes.append((movie_id, rating.score, None))
+            elif rating is None:
+                new_ratings.append(Rating(user=user, movie_id=movie_id, score=score, last_update=now))
+                changes.append((movie_id, None, score))
+            elif rating.score != score:
+                changes.append((movie_id, rating.score, score))
+                rating.score = score
+                rating.last_update = now
+                updated_ratings.append(rating)
+
+        # no upsert in this Django version, hence the separate insert and update
+        Rating.objects.bulk_create(new_ratings)
+        Rating.objects.bulk_update(updated_ratings, ['score', 'last_update'])
+        Rating.objects.filter(id__in=deleted_ids).delete()
+        if changes:
+            user.rating_changed(len(new_ratings) - len(deleted_ids))
+            RECO_INTERFACE.save_predictions(user, changes)
+        return changes
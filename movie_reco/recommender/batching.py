@@ -0,0 +1,86 @@
+import threading
+import time
+
+
+class _Pending:
+    __slots__ = ('item', 'result', 'error', 'lead', 'wake')
+
+    def __init__(self, item):
+        self.item = item
+        self.result = None
+        self.error = None
+        self.lead = False
+        self.wake = threading.Event()
+
+
+class RequestCoalescer:
+    """
+    Gathers the inputs of concurrent callers and runs batch_fn once on all of them.
+    One batch runs at a time: whoever arrives while it runs is queued, and when it is done the first queued
+    caller runs everything queued so far on behalf of the others. Batches thus grow with the load by themselves.
+    While the load is high (the last batch had company), a batch also waits up to max_wait seconds to fill up.
+    No background thread is involved, so it is safe in forking servers.
+    """
+
+    def __init__(self, batch_fn, max_batch_size=32, max_wait=0.005):
+        '''
+        batch_fn: takes a list of inputs, returns a sequence with one result per input
+        '''
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        self._queue = []
+        self._busy = False
+        self._last_batch_size = 0
+
+    def submit(self, item):
+        '''
+        Blocks until the batch the item ended up in is done and returns its result.
+        '''
+        pending = _Pending(item)
+        with self._cond:
+            self._queue.append(pending)
+            pending.lead = not self._busy
+            self._busy = True
+            if len(self._queue) >= self.max_batch_size:
+                self._cond.notify_all()
+        if not pending.lead:
+            pending.wake.wait()
+        # woken up either with a result or to run the next batch, which includes its own input
+        if pending.lead:
+            self._run_next_batch()
+
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _run_next_batch(self):
+        deadline = time.monotonic() + (self.max_wait if self._last_batch_size > 1 else 0)
+        with self._cond:
+            while len(self._queue) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch, self._queue = self._queue[:self.max_batch_size], self._queue[self.max_batch_size:]
+            self._last_batch_size = len(batch)
+
+        try:
+            results = self.batch_fn([pending.item for pending in batch])
+        except Exception as e:
+            for pending in batch:
+                pending.error = e
+        else:
+            for pending, result in zip(batch, results):
+                pending.result = result
+
+        with self._cond:
+            if self._queue:
+                # hand over to the caller that has waited the longest
+                self._queue[0].lead = True
+                self._queue[0].wake.set()
+            else:
+                self._busy = False
+        for pending in batch[1:]:
+            pending.wake.set()
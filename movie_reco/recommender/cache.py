@@ -0,0 +1,167 @@
+import hashlib
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+from .reco_settings import CACHE_BACKEND
+
+
+class LocMemBackend:
+    """
+    In-process LRU store with a TTL. Not shared between worker processes.
+    """
+
+    def __init__(self, max_entries=1000, timeout=1800, **kwargs):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._store = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._store[key]
+            except KeyError:
+                return None
+            if expires < time.time():
+                del self._store[key]
+                return None
+            self._store.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._store[key] = (time.time() + self.timeout, value)
+            self._store.move_to_end(key)
+            while len(self._store) > self.max_entries:
+                self._store.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._store.pop(key, None)
+
+
+class DjangoCacheBackend:
+    """
+    Delegates to one of the caches configured in settings.CACHES (eviction is up to that cache).
+    """
+
+    def __init__(self, alias='default', timeout=1800, **kwargs):
+        self.cache = caches[alias]
+        self.timeout = timeout
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        self.cache.set(key, value, self.timeout)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+
+class FileBackend:
+    """
+    One pickle file per key in a local directory, shared by all workers on the same machine.
+    Entries expire by modification time; the least recently used files are evicted beyond max_entries.
+    """
+
+    def __init__(self, location, max_entries=1000, timeout=1800, **kwargs):
+        self.location = location
+        self.max_entries = max_entries
+        self.timeout = timeout
+        os.makedirs(location, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.location, hashlib.md5(key.encode()).hexdigest() + ".pkl")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if os.path.getmtime(path) + self.timeout < time.time():
+                os.remove(path)
+                return None
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            # another worker may have invalidated the entry meanwhile, which then counts as a miss
+            os.utime(path, (time.time(), os.path.getmtime(path)))
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        return value
+
+    def set(self, key, value):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        entries = [entry for entry in os.scandir(self.location) if entry.name.endswith(".pkl")]
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_atime)
+        for entry in entries[:len(entries) - self.max_entries]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+BACKENDS = {
+    'locmem': LocMemBackend,
+    'django': DjangoCacheBackend,
+    'file': FileBackend,
+}
+
+
+class RecoCache:
+    """
+    Caches recommendation results per user, keyed on the version of their rating set
+    and on the version of the serving parameters they were computed with.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @classmethod
+    def from_settings(cls, options):
+        options = {key.lower(): value for key, value in options.items()}
+        return cls(BACKENDS[options.pop('backend')](**options))
+
+    def _key(self, user_id):
+        return f"reco:{user_id}"
+
+    def _is_current(self, entry, version, params_version):
+        return entry is not None and entry['version'] == version and entry.get('params_version') == params_version
+
+    def get(self, user_id, version, params_version, limit):
+        entry = self.backend.get(self._key(user_id))
+        if not self._is_current(entry, version, params_version):
+            return None
+        return entry['results'].get(limit)
+
+    def set(self, user_id, version, params_version, limit, result):
+        key = self._key(user_id)
+        entry = self.backend.get(key)
+        if not self._is_current(entry, version, params_version):
+            entry = {'version': version, 'params_version': params_version, 'results': {}}
+        entry['results'][limit] = result
+        self.backend.set(key, entry)
+
+    def invalidate(self, user_id):
+        self.backend.delete(self._key(user_id))
+
+
+RECO_CACHE = RecoCache.from_settings(CACHE_BACKEND)
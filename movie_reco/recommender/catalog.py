@@ -0,0 +1,54 @@
+import numpy as np
+
+
+class Catalog:
+    """
+    Mapping between Movie ids and the rows of the model parameters (V, item_bias, temporal_discount...).
+    It is saved along with the parameters, so movies added to the DB after training are simply unknown
+    to the model instead of shifting every row.
+    """
+
+    def __init__(self, item_ids):
+        '''
+        item_ids: the movie id of every row
+        '''
+        self.item_ids = np.asarray(item_ids, dtype=int)
+        size = self.item_ids.max() + 1 if len(self.item_ids) else 0
+        self._rows = np.full(size, -1, dtype=int)
+        self._rows[self.item_ids] = np.arange(len(self.item_ids))
+
+    @classmethod
+    def dense(cls, n_items):
+        # the convention of the parameters trained before the catalog existed: row = id - 1
+        return cls(np.arange(1, n_items + 1))
+
+    def __len__(self):
+        return len(self.item_ids)
+
+    def to_rows(self, movie_ids):
+        '''
+        Returns the row of every movie id, -1 for the ids unknown to the model.
+        '''
+        movie_ids = np.asarray(movie_ids, dtype=int)
+        known = (movie_ids >= 0) & (movie_ids < len(self._rows))
+        rows = np.full(movie_ids.shape, -1, dtype=int)
+        rows[known] = self._rows[movie_ids[known]]
+        return rows
+
+    def to_known_rows(self, movie_ids):
+        '''
+        Returns the rows of the known movie ids and which of the ids they are.
+        '''
+        rows = self.to_rows(movie_ids)
+        known = rows >= 0
+        return rows[known], known
+
+    def to_ids(self, rows):
+        return self.item_ids[rows]
+
+    def take(self, values, movie_ids, default):
+        '''
+        Looks up the per-row values of the given movies, giving the unknown ones the default.
+        '''
+        rows = self.to_rows(movie_ids)
+        return np.where(rows >= 0, values[rows], default)
@@ -0,0 +1,83 @@
+import numpy as np
+from scipy.cluster.hierarchy import linkage as build_linkage, fcluster
+from scipy.sparse import csr_matrix
+from scipy.spatial.distance import squareform
+
+
+class GenreClusterer:
+    """
+    Hierarchical clustering of items on their (L2-normalized) feature vectors,
+    labeled with the genres shared by most members of each cluster.
+    Everything it needs is loaded once, so a request never touches the DB.
+    """
+
+    def __init__(self, item_ids, features, movie_genres, genre_names):
+        '''
+        item_ids: sorted ids of the items in features (one row per item)
+        movie_genres: (movie_id, genre_id) pairs
+        genre_names: {genre_id: label}
+        '''
+        self.item_ids = np.asarray(item_ids)
+        self.features = features
+        genre_ids = sorted(genre_names.keys())
+        self.genre_labels = np.array([genre_names[genre_id] for genre_id in genre_ids], dtype=object)
+
+        pairs = np.array(movie_genres, dtype=int).reshape(-1, 2)
+        pairs = pairs[np.isin(pairs[:, 0], self.item_ids) & np.isin(pairs[:, 1], genre_ids)]
+        rows = np.searchsorted(self.item_ids, pairs[:, 0])
+        cols = np.searchsorted(genre_ids, pairs[:, 1])
+        self.incidence = csr_matrix((np.ones(len(pairs)), (rows, cols)),
+                                    shape=(len(self.item_ids), len(genre_ids)))
+        self.incidence.sum_duplicates()
+        self.incidence.data[:] = 1
+
+    def pairwise_distances(self, movie_ids):
+        '''
+        Returns the applicable (sorted) ids among movie_ids and their cosine distance matrix.
+        The result can be reused by label_clusters for any subset of those ids.
+        '''
+        ids = np.intersect1d(self.item_ids, np.fromiter(movie_ids, dtype=int))
+        X = self.features[np.searchsorted(self.item_ids, ids)]
+        distances = np.clip(1 - X @ X.T, 0, 2)
+        np.fill_diagonal(distances, 0)
+        return ids, distances
+
+    def _cluster(self, distances, linkage, threshold):
+        if len(distances) < 2:
+            return np.zeros(len(distances), dtype=int)
+        Z = build_linkage(squareform(distances, checks=False), method=linkage)
+        return fcluster(Z, threshold, criterion='distance') - 1
+
+    def _label(self, ids, clusters, major_clusters, min_ratio=0.66, max_genres=2):
+        # cluster-by-genre counts for all major clusters in one product
+        positions = np.flatnonzero(np.isin(clusters, major_clusters))
+        membership = csr_matrix((np.ones(len(positions)), (np.searchsorted(major_clusters, clusters[positions]),
+                                                           positions)),
+                                shape=(len(major_clusters), len(ids)))
+        counts = np.asarray((membership @ self.incidence[np.searchsorted(self.item_ids, ids)]).todense())
+        ratios = counts / np.asarray(membership.sum(axis=1))
+
+        top_genres = np.argsort(-counts, axis=1, kind='stable')[:, :max_genres]
+        is_repr = np.take_along_axis(ratios, top_genres, axis=1) >= min_ratio
+        # only a leading run of representative genres counts
+        is_repr = np.cumprod(is_repr, axis=1).astype(bool)
+        return [tuple(self.genre_labels[genres[mask]]) for genres, mask in zip(top_genres, is_repr)]
+
+    def label_clusters(self, movie_ids, distances, k=10, linkage='complete', threshold=0.5):
+        '''
+        Clusters the applicable items among movie_ids, using the matrix returned by pairwise_distances.
+        Returns (representative genres, member ids) of the k largest clusters, largest first.
+        '''
+        all_ids, all_distances = distances
+        mask = np.isin(all_ids, np.fromiter(movie_ids, dtype=int))
+        ids = all_ids[mask]
+        clusters = self._cluster(all_distances[np.ix_(mask, mask)], linkage, threshold)
+
+        sizes = np.bincount(clusters)
+        major_clusters = np.argsort(-sizes, kind='stable')[:k]
+        major_clusters = np.sort(major_clusters[sizes[major_clusters] > 0])
+        if len(major_clusters) == 0:
+            return []
+        labels = self._label(ids, clusters, major_clusters)
+        order = np.argsort(-sizes[major_clusters], kind='stable')
+        return [(labels[i], ids[clusters == major_clusters[i]].tolist()) for i in order]
@@ -0,0 +1,23 @@
+import numpy as np
+from django.db.models import FloatField
+from django.db.models.functions import Cast
+from scipy.sparse import csr_matrix
+
+
+def fetch_ratings(ratings, *fields):
+    '''
+    Reads the given fields plus the score of a Rating queryset with one query, as a float array with one row
+    per rating (score in the last column). The score is cast in SQL, so no Decimal is ever created.
+    '''
+    rows = ratings.order_by().annotate(value=Cast('score', FloatField())).values_list(*fields, 'value')
+    return np.array(list(rows), dtype=float).reshape(-1, len(fields) + 1)
+
+
+def encode_ratings(columns, scores, n_items, rows=None, n_rows=1):
+    '''
+    Builds the (n_rows, n_items) CSR rating matrix directly from arrays. All ratings go to row 0 if rows is None.
+    '''
+    columns = np.asarray(columns, dtype=int)
+    if rows is None:
+        rows = np.zeros(len(columns), dtype=int)
+    return csr_matrix((np.asarray(scores, dtype=float), (rows, columns)), shape=(n_rows, n_items))
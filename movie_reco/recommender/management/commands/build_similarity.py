@@ -0,0 +1,61 @@
+import os
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from sklearn.preprocessing import normalize
+
+from recommender.models import Similarity
+from recommender.neighbors import compute_top_k
+from recommender.reco_interface import RecoInterface
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the Similarity table with the top-k cosine neighbors of every movie"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', choices=['xpc', 'mf', 'both'], default='xpc',
+                            help="item features: tag PCA features, MF item factors, or both (averaged cosine)")
+        parser.add_argument('--k', type=int, default=30)
+        parser.add_argument('--block-size', type=int, default=512)
+        parser.add_argument('--jobs', type=int, default=os.cpu_count())
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def _load_features(self, source):
+        interface = RecoInterface()
+        # the legacy loader can't tell the tagged movies from the rows of the table once they are rewritten
+        interface.save_tagged_item_ids()
+        if source == 'mf':
+            return interface.catalog.item_ids, np.asarray(interface.mf.V)
+
+        item_ids = interface.tagged_item_ids
+        xpc = normalize(interface.xpc)
+        if source == 'xpc':
+            return item_ids, xpc
+        # only the tagged movies the model knows have both features
+        rows, known = interface.catalog.to_known_rows(item_ids)
+        V = normalize(interface.mf.V[rows])
+        return item_ids[known], np.hstack([xpc[known], V]) / np.sqrt(2)
+
+    def handle(self, *args, **options):
+        item_ids, features = self._load_features(options['source'])
+        self.stdout.write(f"Computing top-{options['k']} neighbors of {len(item_ids)} movies...")
+
+        # computed before the transaction, which then only holds the write lock for the swap
+        movie_ids, other_ids, similarities = [], [], []
+        for start, neighbors, scores in compute_top_k(features, options['k'], options['block_size'], options['jobs']):
+            movie_ids.append(np.repeat(item_ids[start:start + len(neighbors)], neighbors.shape[1]))
+            other_ids.append(item_ids[neighbors.ravel()])
+            similarities.append(scores.ravel())
+        rows = list(zip(np.concatenate(movie_ids).tolist(), np.concatenate(other_ids).tolist(),
+                        np.concatenate(similarities).tolist()))
+
+        batch_size = options['batch_size']
+        with transaction.atomic():
+            Similarity.objects.all().delete()
+            for start in range(0, len(rows), batch_size):
+                Similarity.objects.bulk_create([Similarity(movie_id=movie_id, other_movie_id=other_id, score=score)
+                                                for movie_id, other_id, score in rows[start:start + batch_size]])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Saved {len(rows)} similarities. Run export_params to refresh the serving parameters."))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from recommender.neighbors import NeighborIndex
+from recommender.param_store import has_params, load_params, save_params
+from recommender.reco_interface import RecoInterface
+
+
+class Command(BaseCommand):
+    help = "Refreshes the neighbors of the serving parameters from the Similarity table, " \
+           "or exports the pickled model state and the item features into a new parameter store"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--legacy', action='store_true',
+                            help="rebuild everything from the pickled final_151k state, replacing the current model")
+
+    def handle(self, *args, **options):
+        if options['legacy'] or not has_params():
+            interface = RecoInterface(use_param_store=False)
+            version = interface.export_serving_params()
+            self.stdout.write(self.style.SUCCESS(f"Exported serving parameters (version {version})"))
+            return
+
+        # keep the current model (trained or extended since the export), only the neighbors change
+        params, meta = load_params()
+        params.update(NeighborIndex.from_db().to_params())
+        version = save_params(params, meta)
+        self.stdout.write(self.style.SUCCESS(f"Refreshed the neighbors of the serving parameters (version {version})"))
@@ -0,0 +1,62 @@
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from scipy.sparse import csr_matrix
+
+from movies.models import Movie
+from ratings.models import Rating
+from recommender.encoding import fetch_ratings
+from recommender.reco_interface import RecoInterface
+
+
+class Command(BaseCommand):
+    help = "Fits the movies added since the last training against the fixed model and appends them to the serving parameters"
+
+    def add_arguments(self, parser):
+        parser.add_argument('ids', nargs='*', type=int, help="movie ids (default: every movie unknown to the model)")
+        parser.add_argument('--min-ratings', type=int, default=5)
+        parser.add_argument('--lmbda', type=float, default=0.5)
+        parser.add_argument('--chunk-size', type=int, default=1000, help="number of users folded in at once")
+
+    def _new_movies(self, interface, options):
+        movies = Movie.objects.all()
+        if options['ids']:
+            movies = movies.filter(id__in=options['ids'])
+        movie_ids = np.fromiter(movies.values_list('id', flat=True), dtype=int)
+        movie_ids = movie_ids[interface.catalog.to_rows(movie_ids) < 0]
+        counts = Rating.objects.filter(movie_id__in=movie_ids.tolist()).order_by().values('movie_id'). \
+            annotate(n=Count('id')).filter(n__gte=options['min_ratings']).values_list('movie_id', flat=True)
+        return np.sort(np.fromiter(counts, dtype=int))
+
+    def _fold_in_users(self, interface, user_ids, chunk_size):
+        '''
+        Returns the factors of the given users as the serving side sees them, from their ratings of known movies.
+        '''
+        U = np.empty((len(user_ids), interface.mf.K))
+        for start in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[start:start + chunk_size]
+            ratings = fetch_ratings(Rating.objects.filter(user_id__in=chunk.tolist()), 'user_id', 'movie_id')
+            R = interface.encode_ratings(ratings[:, 1].astype(int), ratings[:, 2],
+                                         rows=np.searchsorted(chunk, ratings[:, 0].astype(int)), n_rows=len(chunk))
+            U[start:start + len(chunk)] = interface._fold_in_users(R, [None] * len(chunk))
+        return U
+
+    def handle(self, *args, **options):
+        interface = RecoInterface()
+        movie_ids = self._new_movies(interface, options)
+        if not len(movie_ids):
+            self.stdout.write("No new movie has enough ratings to be folded in.")
+            return
+
+        ratings = fetch_ratings(Rating.objects.filter(movie_id__in=movie_ids.tolist()), 'user_id', 'movie_id')
+        user_ids, columns = np.unique(ratings[:, 0].astype(int), return_inverse=True)
+        self.stdout.write(f"Folding in {len(movie_ids)} movies rated {len(ratings)} times by {len(user_ids)} users...")
+        U = self._fold_in_users(interface, user_ids, options['chunk_size'])
+
+        X = csr_matrix((ratings[:, 2], (np.searchsorted(movie_ids, ratings[:, 1].astype(int)), columns)),
+                       shape=(len(movie_ids), len(user_ids)))
+        V, item_bias = interface.mf.fold_in_items(X, U, lmbda=options['lmbda'])
+        interface.add_items(movie_ids, V, item_bias)
+        version = interface.export_serving_params()
+        self.stdout.write(self.style.SUCCESS(
+            f"Added {len(movie_ids)} movies to the serving parameters (version {version})"))
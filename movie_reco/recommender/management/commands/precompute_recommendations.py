@@ -0,0 +1,111 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from accounts.models import User
+from ratings.models import Rating
+from recommender.encoding import fetch_ratings
+from recommender.models import PrecomputedRecommendation
+from recommender.precompute import render_reco_list
+from recommender.reco_interface import RecoInterface
+
+_interface = None
+
+
+def _recommend_chunk(R, unknown_rated, limit, block_size):
+    '''
+    Recommends for every row of R, unknown_rated holding the rated movies each row leaves out.
+    Scores are computed block_size users at a time with one U @ Vᵀ product.
+    Runs in a worker process and doesn't touch the DB.
+    '''
+    payloads = []
+    for start in range(0, R.shape[0], block_size):
+        block = R[start:start + block_size]
+        U = _interface._fold_in_users(block, [None] * block.shape[0])
+        if _interface.ivf is None:
+            scores = _interface._predict_ratings(block, U)
+        else:
+            scores = _interface._ivf_queries(block, U)
+        for i in range(block.shape[0]):
+            reco_list = _interface.recommend_from_ratings(block[i], limit, scores=scores[i],
+                                                          unknown_rated=unknown_rated[start + i])
+            payloads.append(render_reco_list(reco_list))
+    return payloads
+
+
+class Command(BaseCommand):
+    help = "Computes the recommendation lists of all active users ahead of time"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-ratings', type=int, default=10)
+        parser.add_argument('--limit', type=int, default=100)
+        parser.add_argument('--chunk-size', type=int, default=1000, help="number of users per task")
+        parser.add_argument('--block-size', type=int, default=256, help="number of users scored at once")
+        parser.add_argument('--jobs', type=int, default=1)
+
+    def _load_chunk(self, users):
+        '''
+        Returns the CSR rating matrix of the given (id, rating version) pairs, one row per user,
+        and the rated movies of each user that the model doesn't know.
+        '''
+        user_ids = [user_id for user_id, _ in users]
+        ratings = fetch_ratings(Rating.objects.filter(user_id__in=user_ids), 'user_id', 'movie_id')
+        rows = np.searchsorted(user_ids, ratings[:, 0].astype(int))
+        movie_ids = ratings[:, 1].astype(int)
+        R = _interface.encode_ratings(movie_ids, ratings[:, 2], rows=rows, n_rows=len(user_ids))
+        unknown_rated = [[] for _ in user_ids]
+        for i in np.flatnonzero(_interface.catalog.to_rows(movie_ids) < 0):
+            unknown_rated[rows[i]].append(movie_ids[i])
+        return R, unknown_rated
+
+    def _save_chunk(self, users, payloads, limit, params_version):
+        with transaction.atomic():
+            PrecomputedRecommendation.objects.filter(user_id__in=[user_id for user_id, _ in users]).delete()
+            PrecomputedRecommendation.objects.bulk_create([
+                PrecomputedRecommendation(user_id=user_id, rating_version=rating_version,
+                                          params_version=params_version, limit=limit, payload=payload)
+                for (user_id, rating_version), payload in zip(users, payloads)
+            ], batch_size=500)
+
+    def _chunks(self, options):
+        # rating versions are read before the ratings, so a concurrent write leaves the result outdated, not wrong
+        users = list(User.objects.filter(rating_count__gte=options['min_ratings']).order_by('id').
+                     values_list('id', 'rating_version'))
+        self.stdout.write(f"Precomputing the recommendations of {len(users)} users...")
+        for start in range(0, len(users), options['chunk_size']):
+            chunk = users[start:start + options['chunk_size']]
+            yield (chunk, *self._load_chunk(chunk))
+
+    def _results(self, options):
+        limit, block_size = options['limit'], options['block_size']
+        if options['jobs'] == 1:
+            for users, R, unknown_rated in self._chunks(options):
+                yield users, _recommend_chunk(R, unknown_rated, limit, block_size)
+            return
+
+        # the workers inherit the loaded interface
+        with ProcessPoolExecutor(options['jobs'], mp_context=multiprocessing.get_context('fork')) as executor:
+            pending = []
+            for users, R, unknown_rated in self._chunks(options):
+                pending.append((users, executor.submit(_recommend_chunk, R, unknown_rated, limit, block_size)))
+                # keep a bounded number of chunks in flight
+                while len(pending) > 2 * options['jobs']:
+                    users, future = pending.pop(0)
+                    yield users, future.result()
+            for users, future in pending:
+                yield users, future.result()
+
+    def handle(self, *args, **options):
+        global _interface
+        _interface = RecoInterface()
+
+        n_done = 0
+        for users, payloads in self._results(options):
+            self._save_chunk(users, payloads, options['limit'], _interface.params_version)
+            n_done += len(users)
+            self.stdout.write(f"{n_done} users done")
+
+        self.stdout.write(self.style.SUCCESS(f"Precomputed the recommendations of {n_done} users"))
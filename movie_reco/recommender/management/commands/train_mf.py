@@ -0,0 +1,104 @@
+import os
+from itertools import islice
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from scipy.sparse import csr_matrix
+
+from movies.models import Movie
+from ratings.models import Rating
+from recommender.catalog import Catalog
+from recommender.matfac import MatrixFactorization
+from recommender.reco_interface import RecoInterface
+from recommender.reco_settings import PARAMS_PATH
+
+
+def load_rating_matrix(chunk_size=100000):
+    '''
+    Streams the Rating table into a CSR matrix (one row per user, one column per movie)
+    without creating model instances. Returns the matrix, the user id of each row and the catalog of the columns.
+    '''
+    rows = Rating.objects.order_by().values_list('user_id', 'movie_id', 'score').iterator(chunk_size=chunk_size)
+    user_ids, movie_ids, scores = [np.array([], dtype=int)], [np.array([], dtype=int)], [np.array([])]
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        users, movies, values = zip(*chunk)
+        user_ids.append(np.array(users, dtype=int))
+        movie_ids.append(np.array(movies, dtype=int))
+        scores.append(np.array(values, dtype=float))
+
+    user_ids = np.concatenate(user_ids)
+    movie_ids = np.concatenate(movie_ids)
+    scores = np.concatenate(scores)
+
+    catalog = Catalog(Movie.objects.order_by('id').values_list('id', flat=True))
+    unique_user_ids, user_rows = np.unique(user_ids, return_inverse=True)
+    X = csr_matrix((scores, (user_rows, catalog.to_rows(movie_ids))), shape=(len(unique_user_ids), len(catalog)))
+    return X, unique_user_ids, catalog
+
+
+class Command(BaseCommand):
+    help = "Trains the matrix factorization model on the Rating table and swaps it into the serving parameters"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--name', default="trained", help="prefix of the saved model files")
+        parser.add_argument('--epochs', type=int, default=20)
+        parser.add_argument('--K', type=int, default=8)
+        parser.add_argument('--alpha', type=float, default=0.1)
+        parser.add_argument('--lmbda', type=float, default=0.01)
+        parser.add_argument('--batch-size', type=int, default=50)
+        parser.add_argument('--jobs', type=int, default=1, help="number of worker processes (blocked parallel SGD)")
+        parser.add_argument('--chunk-size', type=int, default=100000)
+        parser.add_argument('--resume', action='store_true', help="continue from the last epoch checkpoint")
+        parser.add_argument('--no-swap', action='store_true', help="train and save without updating the serving parameters")
+
+    def _new_model(self, options):
+        return MatrixFactorization(K=options['K'], alpha=options['alpha'], lmbda=options['lmbda'],
+                                   batch_size=options['batch_size'], n_jobs=options['jobs'],
+                                   verbose=options['verbosity'] > 1)
+
+    def _save_ids(self, prefix, user_ids, catalog):
+        np.save(os.path.join(PARAMS_PATH, prefix + "_user_ids.npy"), user_ids)
+        np.save(os.path.join(PARAMS_PATH, prefix + "_item_ids.npy"), catalog.item_ids)
+
+    def _same_ids(self, prefix, user_ids, catalog):
+        '''
+        Whether the model saved under prefix was trained on the same users and movies, row for row.
+        '''
+        try:
+            saved_user_ids = np.load(os.path.join(PARAMS_PATH, prefix + "_user_ids.npy"))
+            saved_item_ids = np.load(os.path.join(PARAMS_PATH, prefix + "_item_ids.npy"))
+        except FileNotFoundError:
+            return False
+        return np.array_equal(saved_user_ids, user_ids) and np.array_equal(saved_item_ids, catalog.item_ids)
+
+    def handle(self, *args, **options):
+        X, user_ids, catalog = load_rating_matrix(options['chunk_size'])
+        self.stdout.write(f"Loaded {X.nnz} ratings of {X.shape[0]} users on {X.shape[1]} movies")
+
+        checkpoint = options['name'] + "_checkpoint"
+        mf = self._new_model(options)
+        if options['resume'] and os.path.isfile(os.path.join(PARAMS_PATH, checkpoint + "_mfstate.npy")):
+            if self._same_ids(checkpoint, user_ids, catalog):
+                mf.load(checkpoint)
+                mf.n_jobs = options['jobs']
+            else:
+                self.stderr.write("The checkpoint was trained on a different set of users or movies. Starting over.")
+
+        while mf.n_epochs_ < options['epochs']:
+            mf.train(X, 1)
+            mf.save(checkpoint)
+            # written after the state, so that an interrupted save can only make the ids look outdated
+            self._save_ids(checkpoint, user_ids, catalog)
+            self.stdout.write(f"Epoch #{mf.n_epochs_} done")
+
+        mf.save(options['name'])
+        self._save_ids(options['name'], user_ids, catalog)
+
+        if not options['no_swap']:
+            interface = RecoInterface()
+            interface.use_model(mf, catalog)
+            version = interface.export_serving_params()
+            self.stdout.write(self.style.SUCCESS(f"Serving parameters swapped to version {version}"))
@@ -1,15 +1,118 @@
+import mmap
+import multiprocessing
 import os
 import numpy as np
-from scipy.sparse import csr_matrix, dia_matrix
+from scipy.sparse import csr_matrix
 from scipy.sparse.linalg import svds
-from sklearn.preprocessing import normalize
 from .reco_settings import PARAMS_PATH
 
 
+class FoldIn:
+    '''
+    Closed-form (ALS) fold-in of new users against fixed item parameters.
+    V, item_bias and the per-item rows of the Gram matrix VᵀV are computed once,
+    so that each user only costs a single K×K ridge solve over the rated items.
+    '''
+
+    def __init__(self, V, item_bias, mu, gram=None):
+        self.V = V
+        self.item_bias = item_bias
+        self.mu = mu
+        self.K = V.shape[1]
+        # row i holds the flattened outer product v_i v_iᵀ; summing over rated rows gives V_RᵀV_R
+        if gram is None:
+            gram = self.compute_gram(V)
+        self.gram = gram
+
+    @staticmethod
+    def compute_gram(V):
+        K = V.shape[1]
+        return np.einsum('ij,ik->ijk', V, V).reshape(V.shape[0], K * K)
+
+    def solve(self, X: csr_matrix, lmbda=0.5):
+        '''
+        Expected shape of X is (n, d), one user per row. Returns U of shape (n, K).
+        '''
+        X = csr_matrix(X)
+        D = csr_matrix((np.ones_like(X.data), X.indices, X.indptr), shape=X.shape)
+        R = csr_matrix((X.data - self.mu - self.item_bias[X.indices], X.indices, X.indptr), shape=X.shape)
+        A = np.asarray(D @ self.gram).reshape(-1, self.K, self.K) + lmbda * np.eye(self.K)
+        b = np.asarray(R @ self.V)
+        return np.linalg.solve(A, b[..., np.newaxis])[..., 0]
+
+    def normal_equations(self, item_indices, scores, lmbda=0.5):
+        '''
+        Returns the inverse of A = V_RᵀV_R + λI and b = V_Rᵀ(r - μ - bias_R) of one user, so that u = A⁻¹b.
+        '''
+        item_indices = np.asarray(item_indices, dtype=int)
+        A = self.gram[item_indices].sum(axis=0).reshape(self.K, self.K) + lmbda * np.eye(self.K)
+        b = (np.asarray(scores, dtype=float) - self.mu - self.item_bias[item_indices]) @ self.V[item_indices]
+        return np.linalg.inv(A), b
+
+    def update_normal_equations(self, A_inv, b, item_index, old_score=None, new_score=None):
+        '''
+        Applies one rating change (None meaning no rating) to A⁻¹ and b in place, in O(K²):
+        adding or removing an item is a rank-one update or downdate of A (Sherman-Morrison),
+        changing a score only moves b.
+        '''
+        v = self.V[item_index]
+        if old_score is None and new_score is not None:
+            Av = A_inv @ v
+            A_inv -= np.outer(Av, Av) / (1 + v @ Av)
+        elif old_score is not None and new_score is None:
+            Av = A_inv @ v
+            A_inv += np.outer(Av, Av) / (1 - v @ Av)
+        offset = self.mu + self.item_bias[item_index]
+        if old_score is not None:
+            b -= (old_score - offset) * v
+        if new_score is not None:
+            b += (new_score - offset) * v
+
+    def score(self, U, clip=True):
+        prediction = U @ self.V.T + self.mu + self.item_bias
+        if clip:
+            return np.clip(prediction, 0.5, 5.0)
+        else:
+            return prediction
+
+    def predict(self, X: csr_matrix, lmbda=0.5, clip=True):
+        return self.score(self.solve(X, lmbda), clip)
+
+
+_blocked_model = None
+_blocked_data = None
+
+
+def _shared_copy(array):
+    '''
+    Copies the array into anonymous shared memory, which processes forked afterwards write to in place.
+    '''
+    buffer = mmap.mmap(-1, max(array.nbytes, 1))
+    shared = np.frombuffer(buffer, dtype=array.dtype, count=array.size).reshape(array.shape)
+    shared[...] = array
+    return shared
+
+
+def _train_block(p, q, batch_size, alpha):
+    '''
+    Runs the mini-batches of user block p on the items of block q, in a worker process.
+    '''
+    users, user_counts, rows, cols, values = _blocked_data[p][q]
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=len(users)))])
+    for start in range(0, len(users), batch_size):
+        end = min(start + batch_size, len(users))
+        if indptr[start] == indptr[end]:
+            continue
+        nz = slice(indptr[start], indptr[end])
+        _blocked_model._gradient_descent(users[start:end], rows[nz] - start, cols[nz], values[nz],
+                                         user_counts[start:end], alpha=alpha,
+                                         user_share=1 / _blocked_model.n_jobs)
+
+
 class MatrixFactorization():
     def __init__(self, K=8, use_biases=True, alpha=0.1, lmbda=0.01, decay=0.1, momentum=0.75,
                  batch_size=50, batch_growth=1.0, max_size=1024,
-                 init_method="random", verbose=False):
+                 init_method="random", n_jobs=1, verbose=False):
         if init_method not in ("svd", "random"):
             print("Error: valid init_method arguments are: ['svd', 'random']")
             raise ValueError
@@ -25,6 +128,7 @@ class MatrixFactorization():
         self.max_size = max_size
         self.init_method = init_method
         self.momentum = momentum
+        self.n_jobs = n_jobs
         self.U = None
         self.V = None
         self.mu = None
@@ -33,6 +137,7 @@ class MatrixFactorization():
         self.grad_v = None
         self.is_initialized = False
         self.n_epochs_ = 0
+        self.fold_in_ = None
         self.verbose = verbose
 
     def _initialize_parameters(self, X: csr_matrix):
@@ -57,55 +162,115 @@ class MatrixFactorization():
         self.is_initialized = True
 
     def _run_single_epoch(self, X: csr_matrix, batch_size: int, alpha: float):
+        if self.grad_v is None:
+            self.grad_v = np.zeros_like(self.V)
+        if self.n_jobs > 1:
+            self._run_blocked_epoch(X, batch_size, alpha)
+        else:
+            self._run_serial_epoch(X, batch_size, alpha)
+        self.n_epochs_ += 1
+
+    def _run_serial_epoch(self, X: csr_matrix, batch_size: int, alpha: float):
         n, d = X.shape
         indices = np.random.permutation(np.arange(n))
+        # reorder once per epoch, so that every batch is a contiguous slice of the COO triples
+        X = X[indices]
+        cols, values = X.indices, X.data
+        rows = np.repeat(np.arange(n), np.diff(X.indptr))
+        user_counts = np.diff(X.indptr)
+
         for i in range(int(n / batch_size)):
             batch_start = i * batch_size
             batch_end = batch_start + batch_size
-            batch_indices = indices[batch_start:batch_end]
-            X_batch = X[batch_indices]
-            if X_batch.shape[0] == 0:
+            nz = slice(X.indptr[batch_start], X.indptr[batch_end])
+            if nz.start == nz.stop:
                 continue
-            self._gradient_descent(X_batch, batch_indices, alpha=alpha)
-        self.n_epochs_ += 1
+            self._gradient_descent(indices[batch_start:batch_end], rows[nz] - batch_start, cols[nz], values[nz],
+                                   user_counts[batch_start:batch_end], alpha=alpha)
+
+    def _split_blocks(self, X: csr_matrix):
+        '''
+        Splits the ratings into n_jobs × n_jobs blocks of randomly assigned users and items.
+        Block [p][q] holds (global user indices, their total rating counts, user positions in it, item indices,
+        values), sorted by user.
+        '''
+        n, d = X.shape
+        user_blocks = np.array_split(np.random.permutation(n), self.n_jobs)
+        item_block = np.empty(d, dtype=int)
+        for q, items in enumerate(np.array_split(np.random.permutation(d), self.n_jobs)):
+            item_block[items] = q
+
+        blocks = []
+        for users in user_blocks:
+            X_p = X[users]
+            user_counts = np.diff(X_p.indptr)
+            rows = np.repeat(np.arange(len(users)), user_counts)
+            in_block = item_block[X_p.indices]
+            blocks.append([(users, user_counts, rows[in_block == q], X_p.indices[in_block == q],
+                            X_p.data[in_block == q]) for q in range(self.n_jobs)])
+        return blocks
+
+    def _run_blocked_epoch(self, X: csr_matrix, batch_size: int, alpha: float):
+        '''
+        Blocked (DSGD-style) parallel epoch. In each of the n_jobs rounds, worker process p trains the user block p
+        on the item block (p + round) % n_jobs, so that no two processes ever touch the same parameters.
+        The processes are forked with the parameters in shared memory and the blocks inherited.
+        Every user is thus trained in every round, on 1/n_jobs of its ratings, with 1/n_jobs of a full step.
+        '''
+        global _blocked_model, _blocked_data
+        for key in 'U V user_bias item_bias grad_v'.split():
+            setattr(self, key, _shared_copy(getattr(self, key)))
+        _blocked_model, _blocked_data = self, self._split_blocks(X)
+        try:
+            with multiprocessing.get_context('fork').Pool(self.n_jobs) as pool:
+                for r in range(self.n_jobs):
+                    pool.starmap(_train_block, [(p, (p + r) % self.n_jobs, batch_size, alpha)
+                                                for p in range(self.n_jobs)])
+        finally:
+            _blocked_model = _blocked_data = None
+            for key in 'U V user_bias item_bias grad_v'.split():
+                setattr(self, key, np.array(getattr(self, key)))
+
+    def _gradient_descent(self, batch_indices, rows, cols, values, user_counts, alpha, user_share=1.0):
+        '''
+        One step on the nonzero entries of a batch of users only.
+        rows are relative to batch_indices; only the items rated in the batch are updated.
+        user_counts are the users' total rating counts. When the entries are only the user_share of each user's
+        ratings that fall in one block, the user side takes the same share of a full step.
+        '''
+        items, item_rows = np.unique(cols, return_inverse=True)
+        item_counts = np.bincount(item_rows)
+        user_counts = np.maximum(user_counts, 1)
 
-    def _gradient_descent(self, X: csr_matrix, batch_indices, alpha):
         U = self.U[batch_indices]
-        D = csr_matrix(X, dtype=bool)
+        V = self.V[items]
         user_bias = self.user_bias[batch_indices]
-        E = X - D.multiply(self._predict(U, self.V, user_bias))
-
-        EV = E @ self.V
-        EU = E.T @ U
-        with np.errstate(divide='ignore', invalid='ignore'):
-            EV = np.where(EV == 0, 0, EV / D.sum(axis=1))
-            EU = np.where(EU == 0, 0, EU / D.sum(axis=0).T)
+        item_bias = self.item_bias[items]
+        E = values - (np.einsum('ij,ij->i', U[rows], V[item_rows])
+                      + self.mu + user_bias[rows] + item_bias[item_rows])
+        E_batch = csr_matrix((E, (rows, item_rows)), shape=(len(batch_indices), len(items)))
 
-        self.U[batch_indices] += alpha * (EV - self.lmbda * U)
+        EV = (E_batch @ V) / user_counts.reshape(-1, 1)
+        EU = (E_batch.T @ U) / item_counts.reshape(-1, 1)
 
-        if self.grad_v is None:
-            self.grad_v = EU - self.lmbda * self.V
-        else:
-            self.grad_v = self.momentum * self.grad_v + (1 - self.momentum) * (EU - self.lmbda * self.V)
-        self.V += alpha * self.grad_v
+        self.U[batch_indices] += alpha * (EV - user_share * self.lmbda * U)
 
-        user_error_sums = np.ravel(E.sum(axis=1))
-        item_error_sums = np.ravel(E.sum(axis=0))
+        self.grad_v[items] = self.momentum * self.grad_v[items] + (1 - self.momentum) * (EU - self.lmbda * V)
+        self.V[items] += alpha * self.grad_v[items]
 
         if self.use_biases:
-            with np.errstate(divide='ignore', invalid='ignore'):
-                self.user_bias[batch_indices] += alpha * (
-                        np.where(user_error_sums == 0, 0, user_error_sums / np.ravel(D.sum(axis=1)))
-                        - self.lmbda * user_bias)
-                self.item_bias += alpha * (
-                        np.where(item_error_sums == 0, 0, item_error_sums / np.ravel(D.sum(axis=0)))
-                        - self.lmbda * self.item_bias)
+            user_error_sums = np.bincount(rows, weights=E, minlength=len(batch_indices))
+            item_error_sums = np.bincount(item_rows, weights=E, minlength=len(items))
+            self.user_bias[batch_indices] += alpha * (user_error_sums / user_counts
+                                                      - user_share * self.lmbda * user_bias)
+            self.item_bias[items] += alpha * (item_error_sums / item_counts - self.lmbda * item_bias)
 
     def _calculate_batch_size(self, n):
         return min(self.batch_size, self.max_size, n)
 
     def train(self, X: csr_matrix, n_epochs: int):
         n, d = X.shape
+        self.fold_in_ = None
 
         if not isinstance(n_epochs, int):
             print("Invalid type given for parameter n_epochs. Integer object expected.")
@@ -159,48 +324,62 @@ class MatrixFactorization():
     def get_prediction_sample(self, user_index, clip=True):
         return self._predict(U=self.U[user_index], user_bias=self.user_bias[user_index], clip=clip)
 
-    def _solve_for_u(self, X: csr_matrix, user_bias, lmbda):
-        '''
-        Solves the quadratic equation for U given fixed V
-        '''
-        d = X.shape[1]
-        D = csr_matrix(X, dtype=bool)
-        U = (X - D.multiply(self.mu + user_bias + self.item_bias)) @ self.V @ np.linalg.inv(
-            self.V.T @ dia_matrix((D.A, 0), shape=(d, d)) @ self.V + lmbda * np.eye(self.K)
-        )
-        return U
+    def get_fold_in(self):
+        if self.fold_in_ is None:
+            self.fold_in_ = FoldIn(self.V, self.item_bias, self.mu)
+        return self.fold_in_
 
-    def predict_new(self, X: csr_matrix, alpha=0.05, n_iter=20, lmbda=0.5, solve=False, clip=True):
+    def predict_new(self, X: csr_matrix, lmbda=0.5, clip=True):
         '''
         Expected shape of X is (1, d).
         '''
-        D = csr_matrix(X, dtype=bool)
-        count = D.count_nonzero()
-        user_bias = np.zeros(1)
-
-        if solve:
-            U = 0.5 * normalize(self._solve_for_u(X, user_bias, lmbda))
-        else:
-            U = np.random.normal(scale=1 / self.K, size=(1, self.K))
-
-        for i in range(n_iter):
-            E = X - D.multiply(self._predict(U, self.V, user_bias))
-            U += alpha * ((E @ self.V) / count - lmbda * U)
-            # user_bias += alpha * (E.data.mean() - lmbda * user_bias)
+        fold_in = self.get_fold_in()
+        U = fold_in.solve(X, lmbda)
         if self.verbose:
             print("||U|| =", np.linalg.norm(U))
-            # print("Bu =", user_bias)
+        return fold_in.score(U, clip).flatten()
 
-        return self._predict(U, self.V, user_bias, clip).flatten()
+    def fold_in_items(self, X: csr_matrix, U, user_bias=None, lmbda=0.5):
+        '''
+        Closed-form (ALS) fit of new items against fixed user factors, so that movies added after training
+        can be served without retraining. Expected shape of X is (d_new, n), one new item per row and
+        one column per row of U. Returns the new rows of V and item_bias.
+        '''
+        X = csr_matrix(X)
+        if user_bias is None:
+            user_bias = np.zeros(U.shape[0])
+        # the bias is solved for along with the factor, as the weight of a constant feature
+        U = np.hstack([U, np.ones((U.shape[0], 1))])
+        K = U.shape[1]
+        D = csr_matrix((np.ones_like(X.data), X.indices, X.indptr), shape=X.shape)
+        R = csr_matrix((X.data - self.mu - user_bias[X.indices], X.indices, X.indptr), shape=X.shape)
+        A = np.asarray(D @ FoldIn.compute_gram(U)).reshape(-1, K, K) + lmbda * np.eye(K)
+        b = np.asarray(R @ U)
+        solution = np.linalg.solve(A, b[..., np.newaxis])[..., 0]
+        return solution[:, :-1], solution[:, -1]
 
     def save(self, prefix="", compact=False):
         prefix = os.path.join(PARAMS_PATH, prefix)
         state = self.__dict__.copy()
+        state['fold_in_'] = None
         if compact:
             for key in 'U user_bias grad_v'.split():
                 state[key] = None
         np.save(prefix + "_mfstate", state)
 
+    def load_serving_params(self, params, mu):
+        '''
+        Uses the (possibly memory-mapped) arrays of a serving parameter store instead of the pickled state.
+        '''
+        self.V = params['V']
+        self.item_bias = params['item_bias']
+        self.mu = mu
+        self.K = self.V.shape[1]
+        self.is_initialized = True
+        self.fold_in_ = FoldIn(self.V, self.item_bias, self.mu, params.get('gram'))
+
     def load(self, prefix=""):
         prefix = os.path.join(PARAMS_PATH, prefix)
-        self.__dict__ = np.load(prefix + "_mfstate.npy", allow_pickle=True).item()
+        # update rather than replace, so that attributes missing from older states keep their defaults
+        self.__dict__.update(np.load(prefix + "_mfstate.npy", allow_pickle=True).item())
+        self.fold_in_ = None
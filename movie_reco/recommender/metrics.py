@@ -0,0 +1,114 @@
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+
+from django.db import connection
+
+from .reco_settings import METRICS_SAMPLE_RATE
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RequestTimer:
+    """
+    Times the stages of one request and counts the DB queries each of them runs.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    @contextmanager
+    def stage(self, name):
+        queries = [0]
+
+        def count_query(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        t0 = time.perf_counter()
+        with connection.execute_wrapper(count_query):
+            yield
+        self.metrics.observe(name, time.perf_counter() - t0, queries[0])
+
+
+class NullTimer:
+    def stage(self, name):
+        return nullcontext()
+
+
+NULL_TIMER = NullTimer()
+
+
+class StageMetrics:
+    """
+    Per-process stage histograms and query counters, exported in the Prometheus text format.
+    Only a sample_rate fraction of the requests is timed.
+    """
+
+    def __init__(self, prefix, sample_rate=1.0):
+        self.prefix = prefix
+        self.sample_rate = sample_rate
+        self.histograms = {}
+        self.queries = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self.sample_rate >= 1.0 or random.random() < self.sample_rate:
+            return RequestTimer(self)
+        return NULL_TIMER
+
+    def observe(self, stage, seconds, queries):
+        with self._lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = Histogram()
+                self.queries[stage] = 0
+            self.histograms[stage].observe(seconds)
+            self.queries[stage] += queries
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def export(self):
+        lines = []
+        with self._lock:
+            name = f"{self.prefix}_stage_seconds"
+            lines += [f"# HELP {name} Time spent in each recommendation stage (sampled requests).",
+                      f"# TYPE {name} histogram"]
+            for stage, histogram in self.histograms.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+
+            name = f"{self.prefix}_stage_queries_total"
+            lines += [f"# HELP {name} DB queries run in each recommendation stage (sampled requests).",
+                      f"# TYPE {name} counter"]
+            for stage, count in self.queries.items():
+                lines.append(f'{name}{{stage="{stage}"}} {count}')
+
+            for counter, value in self.counters.items():
+                name = f"{self.prefix}_{counter}_total"
+                lines += [f"# TYPE {name} counter", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+RECO_METRICS = StageMetrics("reco", sample_rate=METRICS_SAMPLE_RATE)
@@ -0,0 +1,24 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_user_rating_counters'),
+        ('recommender', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserFactor',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='factor', serialize=False, to='accounts.User')),
+                ('params_version', models.CharField(max_length=64, verbose_name='Serving parameters version')),
+                ('a_inv', models.BinaryField(verbose_name='Inverse of the normal matrix')),
+                ('b', models.BinaryField(verbose_name='Right-hand side')),
+                ('n_updates', models.IntegerField(default=0, verbose_name='# of incremental updates since the last rebuild')),
+                ('last_update', models.DateTimeField(auto_now=True, verbose_name='Last updated on')),
+            ],
+        ),
+    ]
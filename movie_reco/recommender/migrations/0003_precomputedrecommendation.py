@@ -0,0 +1,24 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_user_rating_counters'),
+        ('recommender', '0002_userfactor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PrecomputedRecommendation',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='precomputed_recommendation', serialize=False, to='accounts.User')),
+                ('rating_version', models.IntegerField(verbose_name='Rating set version')),
+                ('params_version', models.CharField(max_length=64, verbose_name='Serving parameters version')),
+                ('limit', models.IntegerField(verbose_name='# of items')),
+                ('payload', models.BinaryField(verbose_name='Rendered response')),
+                ('created', models.DateTimeField(auto_now=True, verbose_name='Computed on')),
+            ],
+        ),
+    ]
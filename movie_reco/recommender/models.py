@@ -17,3 +17,29 @@ class Similarity(models.Model):
             models.UniqueConstraint(fields=["movie", "other_movie"], name="similarity")
         ]
         ordering = ["-score"]
+
+
+class UserFactor(models.Model):
+    """
+    Fold-in state of a user (see FoldIn.normal_equations), updated incrementally on every rating write
+    """
+    user = models.OneToOneField("accounts.User", on_delete=models.CASCADE, primary_key=True,
+                                related_name="factor")
+    params_version = models.CharField(max_length=64, verbose_name="Serving parameters version")
+    a_inv = models.BinaryField(verbose_name="Inverse of the normal matrix")
+    b = models.BinaryField(verbose_name="Right-hand side")
+    n_updates = models.IntegerField(default=0, verbose_name="# of incremental updates since the last rebuild")
+    last_update = models.DateTimeField(auto_now=True, verbose_name="Last updated on")
+
+
+class PrecomputedRecommendation(models.Model):
+    """
+    Recommendation list computed offline (see precompute_recommendations), served while it is current
+    """
+    user = models.OneToOneField("accounts.User", on_delete=models.CASCADE, primary_key=True,
+                                related_name="precomputed_recommendation")
+    rating_version = models.IntegerField(verbose_name="Rating set version")
+    params_version = models.CharField(max_length=64, verbose_name="Serving parameters version")
+    limit = models.IntegerField(verbose_name="# of items")
+    payload = models.BinaryField(verbose_name="Rendered response")
+    created = models.DateTimeField(auto_now=True, verbose_name="Computed on")
@@ -0,0 +1,113 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+from sklearn.preprocessing import normalize
+
+from .models import Similarity
+
+
+class NeighborIndex:
+    """
+    In-memory copy of the Similarity table: the neighbors of movie_ids[i] are
+    neighbor_ids[indptr[i]:indptr[i + 1]], sorted by descending score.
+    """
+
+    def __init__(self, movie_ids, indptr, neighbor_ids, scores):
+        self.movie_ids = movie_ids
+        self.indptr = indptr
+        self.neighbor_ids = neighbor_ids
+        self.scores = scores
+
+    @classmethod
+    def from_db(cls):
+        rows = Similarity.objects.order_by('movie_id', '-score').values_list('movie_id', 'other_movie_id', 'score')
+        rows = np.array(list(rows), dtype=float).reshape(-1, 3)
+        movie_ids, counts = np.unique(rows[:, 0].astype(int), return_counts=True)
+        indptr = np.concatenate([[0], np.cumsum(counts)])
+        return cls(movie_ids, indptr, rows[:, 1].astype(int), rows[:, 2])
+
+    @classmethod
+    def from_params(cls, params):
+        return cls(params['neighbor_movie_ids'], params['neighbor_indptr'],
+                   params['neighbor_ids'], params['neighbor_scores'])
+
+    def to_params(self):
+        return {
+            'neighbor_movie_ids': self.movie_ids,
+            'neighbor_indptr': self.indptr,
+            'neighbor_ids': self.neighbor_ids,
+            'neighbor_scores': self.scores,
+        }
+
+    def _rows(self, movie_ids):
+        movie_ids = np.asarray(movie_ids, dtype=int)
+        rows = np.searchsorted(self.movie_ids, movie_ids).clip(0, len(self.movie_ids) - 1)
+        return rows, self.movie_ids[rows] == movie_ids
+
+    def get(self, movie_id, limit=20):
+        if len(self.movie_ids) == 0:
+            return np.array([], dtype=int)
+        rows, found = self._rows([movie_id])
+        if not found[0]:
+            return np.array([], dtype=int)
+        start = self.indptr[rows[0]]
+        return self.neighbor_ids[start:min(start + limit, self.indptr[rows[0] + 1])]
+
+    def gather(self, movie_ids, limit=20):
+        '''
+        Returns the top neighbors of several movies at once as a (len(movie_ids), limit) array padded with -1.
+        '''
+        if len(self.movie_ids) == 0:
+            return np.full((len(movie_ids), limit), -1)
+        rows, found = self._rows(movie_ids)
+        starts = self.indptr[rows]
+        lengths = np.where(found, np.minimum(self.indptr[rows + 1] - starts, limit), 0)
+        offsets = np.arange(limit)
+        valid = offsets < lengths.reshape(-1, 1)
+        positions = np.where(valid, starts.reshape(-1, 1) + offsets, 0)
+        return np.where(valid, self.neighbor_ids[positions], -1)
+
+    def sample(self, movie_ids, limit=20, size=1):
+        '''
+        Draws (without replacement) up to size ids from the top-limit neighbors of each movie.
+        '''
+        neighbors = self.gather(movie_ids, limit)
+        keys = np.where(neighbors >= 0, np.random.random(neighbors.shape), np.inf)
+        picked = np.take_along_axis(neighbors, np.argsort(keys, axis=1)[:, :size], axis=1)
+        return picked[picked >= 0]
+
+
+_features = None
+
+
+def _init_worker(features):
+    global _features
+    _features = features
+
+
+def _top_k_block(start, end, k):
+    similarities = _features[start:end] @ _features.T
+    similarities[np.arange(end - start), np.arange(start, end)] = -np.inf
+    top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(similarities, top, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    return start, np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+def compute_top_k(features, k=20, block_size=512, n_jobs=1):
+    '''
+    Yields (first row, neighbor rows, cosine similarities) for consecutive row blocks of features.
+    Only a block_size × n similarity block is held in memory at a time (per worker).
+    '''
+    features = normalize(features)
+    n = len(features)
+    k = min(k, n - 1)
+    starts = range(0, n, block_size)
+    ends = [min(start + block_size, n) for start in starts]
+    if n_jobs == 1:
+        _init_worker(features)
+        yield from map(_top_k_block, starts, ends, repeat(k))
+    else:
+        with ProcessPoolExecutor(n_jobs, initializer=_init_worker, initargs=(features,)) as executor:
+            yield from executor.map(_top_k_block, starts, ends, repeat(k))
@@ -0,0 +1,59 @@
+"""
+Flat, pickle-free storage of the serving parameters.
+
+Every array is written as a plain .npy file and opened with mmap_mode='r', so all worker processes
+on a machine map the same read-only pages through the page cache instead of each holding a copy.
+Each export goes to its own versioned directory and the CURRENT file is switched atomically,
+so readers never see a half-written set of parameters.
+"""
+import json
+import os
+import time
+
+import numpy as np
+
+from .reco_settings import SERVING_PATH
+
+
+def _current_file(path):
+    return os.path.join(path, "CURRENT")
+
+
+def has_params(path=SERVING_PATH):
+    return os.path.isfile(_current_file(path))
+
+
+def current_version(path=SERVING_PATH):
+    with open(_current_file(path)) as f:
+        return f.read().strip()
+
+
+def save_params(arrays, meta, path=SERVING_PATH):
+    version = time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}"
+    directory = os.path.join(path, version)
+    os.makedirs(directory)
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, name + ".npy"), np.ascontiguousarray(array))
+    with open(os.path.join(directory, "meta.json"), "w") as f:
+        json.dump(dict(meta, version=version), f)
+
+    tmp_file = _current_file(path) + f".{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, _current_file(path))
+    return version
+
+
+def load_params(path=SERVING_PATH, version=None):
+    if version is None:
+        version = current_version(path)
+    directory = os.path.join(path, version)
+    with open(os.path.join(directory, "meta.json")) as f:
+        meta = json.load(f)
+    arrays = {}
+    for filename in os.listdir(directory):
+        if filename.endswith(".npy"):
+            arrays[filename[:-4]] = np.load(os.path.join(directory, filename), mmap_mode='r')
+    return arrays, meta
@@ -0,0 +1,20 @@
+from rest_framework.renderers import JSONRenderer
+
+from .models import PrecomputedRecommendation
+
+
+def render_reco_list(reco_list):
+    res_data = []
+    for label, items in reco_list.items():
+        entry = {"label": label, "items": items}
+        res_data.append(entry)
+    return JSONRenderer().render(res_data)
+
+
+def get_precomputed(user, limit, params_version):
+    '''
+    Returns the rendered recommendation list computed offline for the user, if it is still current.
+    '''
+    entry = PrecomputedRecommendation.objects.filter(
+        user=user, rating_version=user.rating_version, params_version=params_version, limit=limit).first()
+    return None if entry is None else bytes(entry.payload)
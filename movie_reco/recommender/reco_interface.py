@@ -1,14 +1,26 @@
 import os
+import threading
 import numpy as np
-import pandas as pd
-from scipy.sparse import dok_matrix
-from sklearn.cluster import AgglomerativeClustering
-from movies.models import Movie
-from .matfac import MatrixFactorization
+from django.utils.functional import SimpleLazyObject
+from scipy.sparse import vstack
+from metadata.models import Genre
+from movies.models import Movie, MovieGenre
+from .batching import RequestCoalescer
+from .catalog import Catalog
+from .clustering import GenreClusterer
+from .encoding import fetch_ratings, encode_ratings
+from .matfac import MatrixFactorization, FoldIn
+from .metrics import RECO_METRICS, NULL_TIMER
 from .models import Similarity
-from .reco_settings import PARAMS_PATH
+from .neighbors import NeighborIndex
+from .param_store import has_params, load_params, save_params
+from .reco_settings import PARAMS_PATH, RETRIEVAL_METHOD, BATCHING
+from .retrieval import top_n, IVFIndex
+from .user_factors import UserFactorStore
 from sklearn.preprocessing import normalize
 
+TAGGED_ITEMS_FILE = "tagged_item_ids.npy"
+
 
 class RecoInterface:
     """
@@ -17,69 +29,260 @@ class RecoInterface:
     Other parts of the web application should remain completely ignorant of the inner workings of ML algorithms.
     """
 
-    def __init__(self):
+    def __init__(self, use_param_store=True):
         self.mf = MatrixFactorization()
+        self.mf.verbose = False
+        if use_param_store and has_params():
+            self._load_serving_params()
+        else:
+            self._load_legacy_params()
+        self.xpc_normalized = normalize(self.xpc)
+        self._align_xpc()
+        self.clusterer = GenreClusterer(self.tagged_item_ids, self.xpc_normalized,
+                                        MovieGenre.objects.values_list('movie_id', 'genre_id'),
+                                        dict(Genre.objects.values_list('id', 'name_kr')))
+        self.label_etc = ("미분류",)
+        self.ivf = self._build_ivf_index() if RETRIEVAL_METHOD == "ivf" else None
+        self.coalescer = None
+        if BATCHING["ENABLED"]:
+            self.coalescer = RequestCoalescer(self._score_coalesced, BATCHING["MAX_BATCH_SIZE"], BATCHING["MAX_WAIT"])
+        self.user_factors = UserFactorStore(self.mf.get_fold_in(), self.catalog, 0.5, self.params_version)
+        self.eval_pool, self.eval_weights = self._build_eval_pool()
+
+    def _load_serving_params(self):
+        params, meta = load_params()
+        self.mf.load_serving_params(params, meta['mu'])
+        self.tagged_item_ids = params['tagged_item_ids']
+        self.xpc = params['xpc']
+        self.temporal_discount = params['temporal_discount']
+        if 'item_ids' in params:
+            self.catalog = Catalog(params['item_ids'])
+        else:
+            self.catalog = Catalog.dense(len(self.mf.V))
+        if 'neighbor_indptr' in params:
+            self.neighbors = NeighborIndex.from_params(params)
+        else:
+            self.neighbors = NeighborIndex.from_db()
+        self.params_version = meta['version']
+
+    def _load_legacy_params(self):
         self.mf.load("final_151k")
         self.mf.verbose = False
-        self.tagged_item_ids = np.array(Similarity.objects.values('movie_id').distinct().
-                                        order_by('movie_id').values_list('movie_id', flat=True))
-        self.all_item_ids = np.arange(1, 9527)
+        self.mf.get_fold_in()
+        self.catalog = Catalog.dense(len(self.mf.V))
         self.xpc = self._load_xpc(25)
+        self.tagged_item_ids = self._load_tagged_item_ids()
         self.temporal_discount = self._compute_temporal_discount(2010, 0.015)
-        self.label_etc = ("미분류",)
+        self.neighbors = NeighborIndex.from_db()
+        self.params_version = "legacy"
+
+    def export_serving_params(self):
+        arrays = {
+            'item_ids': self.catalog.item_ids,
+            'V': self.mf.V,
+            'item_bias': self.mf.item_bias,
+            'gram': self.mf.get_fold_in().gram,
+            'tagged_item_ids': self.tagged_item_ids,
+            'xpc': self.xpc,
+            'temporal_discount': self.temporal_discount,
+            **self.neighbors.to_params(),
+        }
+        return save_params(arrays, {'mu': float(self.mf.mu), 'K': int(self.mf.K)})
+
+    def use_model(self, mf, catalog):
+        '''
+        Serves a newly trained model whose rows are the movies of the given catalog.
+        '''
+        self.mf = mf
+        self.catalog = catalog
+        self.temporal_discount = self._compute_temporal_discount(2010, 0.015)
+        self._align_xpc()
+
+    def add_items(self, movie_ids, V, item_bias):
+        '''
+        Appends model rows for movies the model doesn't know yet (see MatrixFactorization.fold_in_items).
+        '''
+        gram = np.vstack([self.mf.get_fold_in().gram, FoldIn.compute_gram(V)])
+        self.mf.V = np.vstack([self.mf.V, V])
+        self.mf.item_bias = np.concatenate([self.mf.item_bias, item_bias])
+        self.mf.fold_in_ = FoldIn(self.mf.V, self.mf.item_bias, self.mf.mu, gram)
+        self.use_model(self.mf, Catalog(np.concatenate([self.catalog.item_ids, movie_ids])))
+
+    def _align_xpc(self):
+        # tag features of the tagged movies the model knows, in the order of their model rows
+        self.xpc_rows, known = self.catalog.to_known_rows(self.tagged_item_ids)
+        self.model_xpc = self.xpc[known]
+        self.model_xpc_normalized = self.xpc_normalized[known]
 
     def _load_xpc(self, n_components):
         data = np.load(os.path.join(PARAMS_PATH, "movie_features_pc50.npy"))
-        return pd.DataFrame(data, index=self.tagged_item_ids)[np.arange(n_components)]
+        return data[:, :n_components]
+
+    def _load_tagged_item_ids(self):
+        '''
+        The movie id of every row of the tag features.
+        '''
+        path = os.path.join(PARAMS_PATH, TAGGED_ITEMS_FILE)
+        if os.path.isfile(path):
+            item_ids = np.load(path)
+        else:
+            # older setups: the Similarity table was built from the tag features, with one movie per row of them
+            item_ids = np.array(Similarity.objects.values('movie_id').distinct().
+                                order_by('movie_id').values_list('movie_id', flat=True))
+        if len(item_ids) != len(self.xpc):
+            raise ValueError(f"{len(item_ids)} tagged movies for {len(self.xpc)} rows of tag features. "
+                             f"Restore {TAGGED_ITEMS_FILE} next to the tag features.")
+        return item_ids
+
+    def save_tagged_item_ids(self):
+        '''
+        Writes the tagged movie ids next to the tag features, so that they no longer depend on the Similarity table.
+        '''
+        path = os.path.join(PARAMS_PATH, TAGGED_ITEMS_FILE)
+        if os.path.isfile(path):
+            return
+        tmp_path = path + f".{os.getpid()}.tmp.npy"
+        np.save(tmp_path, self.tagged_item_ids)
+        os.replace(tmp_path, path)
 
     def _compute_temporal_discount(self, threshold, decay_rate):
-        years = np.array(Movie.objects.order_by(
-            'id').values_list('release_year', flat=True))
-        return np.clip(years - threshold, None, 0) * decay_rate
-
-    def _encode_ratings(self, ratings_list):
-        X = dok_matrix((1, 9526))
-        for movie_id, score in ratings_list:
-            X[0, movie_id - 1] = score
-        return X.tocsr()
-
-    def _count_occurrences(self, array):
-        count = {}
-        for val in array:
-            count[val] = count.get(val, 0) + 1
-        return count
+        movies = np.array(Movie.objects.filter(release_year__isnull=False).values_list('id', 'release_year'),
+                          dtype=int).reshape(-1, 2)
+        rows, known = self.catalog.to_known_rows(movies[:, 0])
+        # rows without a movie (deleted since training) or without a release year are not discounted
+        discount = np.zeros(len(self.catalog))
+        discount[rows] = np.clip(movies[known, 1] - threshold, None, 0) * decay_rate
+        return discount
+
+    def _build_ivf_index(self):
+        # item side of the score without clipping: [V | normalized xpc (zero for untagged items) | mu + item bias +
+        # temporal discount]. It only selects the candidates, which are then rescored exactly (see _rescore).
+        xpc = np.zeros((len(self.catalog), self.xpc.shape[1]))
+        xpc[self.xpc_rows] = self.model_xpc_normalized
+        offset = self.mf.mu + self.mf.item_bias + self.temporal_discount
+        return IVFIndex(np.hstack([self.mf.V, xpc, offset.reshape(-1, 1)]))
+
+    def _build_eval_pool(self):
+        '''
+        Well-known movies that new users are asked to rate, and how informative a rating of each one is:
+        items with large factors move the fold-in the most, and popular ones are more likely to be known.
+        Movies newer than the model get the median factor norm.
+        '''
+        pool = np.array(Movie.objects.filter(imdb_votes__gte=3*10**5).filter(imdb_score__gte=6.0).
+                        filter(imdb_score__lte=9.0).order_by('id').values_list('id', 'imdb_votes'),
+                        dtype=int).reshape(-1, 2)
+        norms = np.linalg.norm(self.mf.V, axis=1)
+        weights = self.catalog.take(norms, pool[:, 0], np.median(norms)) * np.log1p(pool[:, 1])
+        return pool[:, 0], weights
+
+    def encode_ratings(self, movie_ids, scores, rows=None, n_rows=1):
+        '''
+        Builds the CSR rating matrix over the model rows. Ratings of movies unknown to the model are left out,
+        which is the same as leaving their scores neutral.
+        '''
+        columns, known = self.catalog.to_known_rows(movie_ids)
+        if rows is not None:
+            rows = rows[known]
+        return encode_ratings(columns, scores[known], len(self.catalog), rows=rows, n_rows=n_rows)
+
+    def _encode_ratings(self, user):
+        '''
+        Returns the user's rating row and the rated movies it leaves out.
+        '''
+        ratings = fetch_ratings(user.ratings.all(), 'movie_id')
+        movie_ids = ratings[:, 0].astype(int)
+        return self.encode_ratings(movie_ids, ratings[:, 1]), movie_ids[self.catalog.to_rows(movie_ids) < 0]
 
     def get_similar_items(self, movie, limit=20):
-        return movie.similar_items.all()[:limit].values_list('other_movie__id', flat=True)
-
-    def _predict_ratings(self, R):
-        tagged_indices = self.tagged_item_ids - 1
-        pred = self.mf.predict_new(
-            R, alpha=0.05, lmbda=0.005, n_iter=30, solve=False)  # d=9526
-        sim2pref = normalize(R[:, tagged_indices] @
-                             self.xpc) @ normalize(self.xpc).T  # d=8048
-        pred[tagged_indices] += 0.25 * sim2pref.flatten()
+        return self.neighbors.get(movie.id, limit).tolist()
+
+    def _fold_in_users(self, R, known, timer=NULL_TIMER):
+        '''
+        Returns U, one row per row of R. Rows whose factor is known (not None) aren't solved for.
+        '''
+        with timer.stage('mf_fold_in'):
+            U = np.empty((R.shape[0], self.mf.K))
+            missing = [i for i, u in enumerate(known) if u is None]
+            if missing:
+                U[missing] = self.mf.get_fold_in().solve(R[missing], lmbda=0.5)
+            for i, u in enumerate(known):
+                if u is not None:
+                    U[i] = u
+        return U
+
+    def _predict_ratings(self, R, U, timer=NULL_TIMER):
+        '''
+        Returns the predicted ratings of every item, one row per row of R.
+        '''
+        with timer.stage('mf_scoring'):
+            pred = self.mf.get_fold_in().score(U)
+        with timer.stage('xpc_projection'):
+            sim2pref = normalize(R[:, self.xpc_rows] @
+                                 self.model_xpc) @ self.model_xpc_normalized.T
+            pred[:, self.xpc_rows] += 0.25 * sim2pref
         pred += self.temporal_discount
         return pred
 
-    def _cluster_and_label(self, movie_ids, k=10, linkage='complete', threshold=0.5):
-        applicable_ids = sorted(
-            list(set(self.tagged_item_ids).intersection(set(movie_ids))))
-        xpc = self.xpc.loc[applicable_ids].copy()
-        applicable_ids = xpc.index.values
+    def _ivf_queries(self, R, U, timer=NULL_TIMER):
+        '''
+        Returns the query vectors of the IVF index, one row per row of R.
+        '''
+        with timer.stage('xpc_projection'):
+            sim = normalize(R[:, self.xpc_rows] @ self.model_xpc)
+        return np.hstack([U, 0.25 * sim, np.ones((R.shape[0], 1))])
+
+    def _score_batch(self, requests, timer=NULL_TIMER):
+        '''
+        requests: (R, u) of each user, u being None if the user's factor is not known.
+        Returns either the predicted ratings or the IVF queries, one row per user.
+        '''
+        R = requests[0][0] if len(requests) == 1 else vstack([R for R, _ in requests], format='csr')
+        U = self._fold_in_users(R, [u for _, u in requests], timer)
+        if self.ivf is None:
+            return self._predict_ratings(R, U, timer)
+        return self._ivf_queries(R, U, timer)
+
+    def _score_coalesced(self, requests):
+        # the stages of a coalesced batch are timed once, on behalf of all the requests in it
+        return self._score_batch(requests, RECO_METRICS.start())
 
+    def _score(self, R, u, timer):
+        if self.coalescer is not None:
+            with timer.stage('batched_scoring'):
+                return self.coalescer.submit((R, u))
+        return self._score_batch([(R, u)], timer)[0]
+
+    def _rescore(self, query, rows):
+        '''
+        The exact score (see _predict_ratings) of the given rows for an IVF query, whose inner product with the items
+        leaves the CF part unclipped.
+        '''
+        K = self.mf.K
+        cf = np.clip(self.mf.V[rows] @ query[:K] + self.mf.mu + self.mf.item_bias[rows], 0.5, 5.0)
+        return cf + self.ivf.items[rows, K:-1] @ query[K:-1] + self.temporal_discount[rows]
+
+    def _get_best_items(self, R, n, exclude, u=None, scores=None, timer=NULL_TIMER):
+        '''
+        Returns the DB ids of the n best items, leaving out the ids in exclude.
+        u is the user's factor, if known.
+        '''
+        exclude, _ = self.catalog.to_known_rows(list(exclude))
+        if scores is None:
+            scores = self._score(R, u, timer)
+        with timer.stage('argsort'):
+            if self.ivf is None:
+                best = top_n(scores, n, exclude)
+            else:
+                best = self.ivf.search(scores, n, exclude, rescore=lambda rows: self._rescore(scores, rows))
+        return self.catalog.to_ids(best)
+
+    def _cluster_and_label(self, movie_ids, distances, k=10, linkage='complete', threshold=0.5):
         # Needs more tests on clustering parameters
-        agg = AgglomerativeClustering(n_clusters=None, affinity='cosine', linkage=linkage,
-                                      distance_threshold=threshold)
-        clusters = agg.fit_predict(xpc)
-        count = self._count_occurrences(clusters)
-        major_clusters = sorted(count.keys(), key=count.get, reverse=True)[:k]
+        clusters = self.clusterer.label_clusters(movie_ids, distances, k=k, linkage=linkage, threshold=threshold)
 
         clustered_items = []
         labeled_reco_list = {}
-        for label in major_clusters:
-            member_ids = applicable_ids[clusters == label].tolist()
-            repr_genres = tuple(self._get_representative_genres(member_ids))
+        for repr_genres, member_ids in clusters:
             if not repr_genres:
                 continue
             try:
@@ -95,67 +298,67 @@ class RecoInterface:
             set(movie_ids) - set(clustered_items))
         return labeled_reco_list
 
-    def _get_representative_genres(self, movie_ids):
-        genres = Movie.objects.filter(id__in=movie_ids).values_list(
-            'genres__genre__name_kr', flat=True)
-        count = self._count_occurrences(genres)
-        sorted_ratios = {
-            k: count[k] / len(movie_ids) for k in sorted(count.keys(), key=count.get, reverse=True)}
-        repr_genres = []
-        for genre, ratio in sorted_ratios.items():
-            if ratio >= 0.66:
-                repr_genres.append(genre)
-            else:
-                break
-            if len(repr_genres) >= 2:
-                break
-        return repr_genres
-
     def get_recommendation(self, user, limit=100):
-        # by default ratings are sorted by score in descending order
-        ratings = user.ratings.all()
-        R = self._encode_ratings(ratings.values_list("movie__id", "score"))
-        rated = set(ratings.values_list('movie__id', flat=True))
+        timer = RECO_METRICS.start()
+        with timer.stage('total'):
+            return self._recommend(user, limit, timer)
+
+    def _recommend(self, user, limit, timer):
+        with timer.stage('encode'):
+            R, unknown_rated = self._encode_ratings(user)
+            u = self.user_factors.get(user)
+        return self.recommend_from_ratings(R, limit, u=u, unknown_rated=unknown_rated, timer=timer)
+
+    def _favorites(self, R, limit=15, min_score=4.0):
+        # the best-rated items, best first
+        order = np.argsort(-R.data, kind='stable')[:limit]
+        return self.catalog.to_ids(R.indices[order[R.data[order] >= min_score]])
+
+    def recommend_from_ratings(self, R, limit=100, u=None, scores=None, unknown_rated=(), timer=NULL_TIMER):
+        '''
+        Recommends from a (1, d) rating row without touching the DB.
+        u (the user's factor) and scores (the output of _score_batch for the user) are computed if not given.
+        unknown_rated: the rated movies R leaves out because the model doesn't know them
+        '''
+        rated = set(self.catalog.to_ids(R.indices).tolist()) | set(np.asarray(unknown_rated).tolist())
         reco_list = []
 
         # recommendation by item-item similarity
-        user_favorites = ratings.filter(score__gte=4.0)[:15]
-        for fav in user_favorites:
-            similar_items = np.random.choice(self.get_similar_items(fav.movie, 20),
-                                             size=min(30//len(user_favorites), 10),
-                                             replace=False)
-            reco_list += similar_items.tolist()
+        with timer.stage('item_item'):
+            user_favorites = self._favorites(R)
+            if len(user_favorites):
+                similar_items = self.neighbors.sample(user_favorites, 20, size=min(30//len(user_favorites), 10))
+                reco_list += similar_items.tolist()
 
         reco_list = set(reco_list) - rated
 
-        # recommendation by CF
-        cf_prediction = self._predict_ratings(R)
-        # +1 because DB ids start from 1
-        cf_best_items = cf_prediction.argsort(
-        )[::-1][:limit + ratings.count()] + 1
-
-        # fill up to limit
+        # recommendation by CF, fill up to limit
+        cf_best_items = self._get_best_items(R, limit + len(reco_list), exclude=rated, u=u, scores=scores,
+                                             timer=timer)
         for item in cf_best_items:
-            if item not in rated:
-                reco_list.add(item)
-                if len(reco_list) >= limit:
-                    break
+            reco_list.add(item)
+            if len(reco_list) >= limit:
+                break
 
         # perform clustering and put labels
-        clustered_list = self._cluster_and_label(
-            reco_list, k=10, linkage='complete', threshold=0.5)
+        # the distance matrix is shared with the re-clustering pass
+        with timer.stage('clustering'):
+            distances = self.clusterer.pairwise_distances(reco_list)
+            clustered_list = self._cluster_and_label(
+                reco_list, distances, k=10, linkage='complete', threshold=0.5)
 
-        # partially re-cluster with relaxed constraints if too many items are labels as "미분류"
-        if len(clustered_list[self.label_etc]) > 20:
-            clustered_list = self._partial_reclustering(
-                clustered_list, self.label_etc, linkage='average', threshold=0.5)
+        with timer.stage('relabeling'):
+            # partially re-cluster with relaxed constraints if too many items are labels as "미분류"
+            if len(clustered_list[self.label_etc]) > 20:
+                clustered_list = self._partial_reclustering(
+                    clustered_list, self.label_etc, distances, linkage='average', threshold=0.5)
 
-        # reorder dictionary
-        clustered_list = self._sort_dict_by_len(
-            clustered_list, reverse=True, shuffle=True)
-        etc = clustered_list[self.label_etc]
-        del clustered_list[self.label_etc]
-        clustered_list[self.label_etc] = etc
+            # reorder dictionary
+            clustered_list = self._sort_dict_by_len(
+                clustered_list, reverse=True, shuffle=True)
+            etc = clustered_list[self.label_etc]
+            del clustered_list[self.label_etc]
+            clustered_list[self.label_etc] = etc
 
         return clustered_list
 
@@ -168,11 +371,11 @@ class RecoInterface:
                 new_dict[key] = dic[key]
         return new_dict
 
-    def _partial_reclustering(self, labeled_items, key, linkage, threshold):
+    def _partial_reclustering(self, labeled_items, key, distances, linkage, threshold):
         etcetera = labeled_items[key]
         clustered_items = labeled_items.copy()
         reclustered = self._cluster_and_label(
-            etcetera, linkage=linkage, threshold=threshold)
+            etcetera, distances, linkage=linkage, threshold=threshold)
         del reclustered[key]
         moved_items = []
         for label, items in reclustered.items():
@@ -196,18 +399,48 @@ class RecoInterface:
         return clustered_items
 
     def get_eval_list(self, user, limit=100):
-        rated_movies = user.ratings.values_list('movie', flat=True)
+        rated_movies = np.fromiter(user.ratings.values_list('movie_id', flat=True), dtype=int)
+        unrated = ~np.isin(self.eval_pool, rated_movies)
+        candidates, weights = self.eval_pool[unrated], self.eval_weights[unrated]
+
+        # weighted sampling without replacement (Efraimidis-Spirakis): the limit largest u^(1/w)
+        keys = np.log(np.random.random(len(candidates))) / weights
+        if limit < len(candidates):
+            chosen = np.argpartition(-keys, limit - 1)[:limit]
+        else:
+            chosen = np.arange(len(candidates))
+        return candidates[chosen[np.argsort(-keys[chosen])]]
+
+    def save_predictions(self, user, changes):
+        '''
+        Keeps the user's stored factor in step with a rating write (see UserFactorStore.apply).
+        '''
+        self.user_factors.apply(user, changes)
+
+
+_reco_interface = None
+_reco_interface_lock = threading.Lock()
+
+
+def _reset_lock():
+    global _reco_interface_lock
+    _reco_interface_lock = threading.Lock()
+
+
+# a lock held by another thread at fork time would never be released in the child
+os.register_at_fork(after_in_child=_reset_lock)
 
-        # simply return the id of the movies
-        eval_candidates = Movie.objects.filter(imdb_votes__gte=3*10**5).filter(imdb_score__gte=6.0).\
-            filter(imdb_score__lte=9.0).exclude(
-                id__in=rated_movies).values_list('id', flat=True)
-        eval_list = np.random.choice(
-            eval_candidates, size=limit, replace=False)
-        return eval_list
 
-    def save_predictions(self, user, preds):
-        pass
+def get_reco_interface():
+    '''
+    Loads the interface on first use, so that importing views (e.g. for manage.py commands) stays cheap.
+    '''
+    global _reco_interface
+    if _reco_interface is None:
+        with _reco_interface_lock:
+            if _reco_interface is None:
+                _reco_interface = RecoInterface()
+    return _reco_interface
 
 
-RECO_INTERFACE = RecoInterface()
+RECO_INTERFACE = SimpleLazyObject(get_reco_interface)
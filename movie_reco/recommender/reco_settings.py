@@ -1,3 +1,29 @@
 import os
 
-PARAMS_PATH = os.path.dirname(os.path.abspath(__file__)) + "/trained_params/"
\ No newline at end of file
+PARAMS_PATH = os.path.dirname(os.path.abspath(__file__)) + "/trained_params/"
+SERVING_PATH = os.path.join(PARAMS_PATH, "serving")
+
+# "exact": score every item and select the top-N with a partial sort
+# "ivf": approximate maximum-inner-product search over an inverted-file index built at load time
+RETRIEVAL_METHOD = "exact"
+
+# coalesce the scoring of concurrent recommendation requests into one matrix operation:
+# the first request waits up to MAX_WAIT seconds for others to join its batch
+BATCHING = {
+    "ENABLED": True,
+    "MAX_BATCH_SIZE": 32,
+    "MAX_WAIT": 0.005,
+}
+
+# per-user recommendation cache; BACKEND is one of "locmem", "django" or "file"
+CACHE_BACKEND = {
+    "BACKEND": "locmem",
+    "MAX_ENTRIES": 1000,
+    "TIMEOUT": 60 * 30,
+    "LOCATION": os.path.join(os.path.dirname(os.path.abspath(__file__)), "reco_cache"),
+}
+
+# fraction of recommendation requests whose stages are timed
+METRICS_SAMPLE_RATE = 1.0
+# clients allowed to read the metrics view
+METRICS_ALLOWED_IPS = ("127.0.0.1", "::1")
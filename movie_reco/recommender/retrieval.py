@@ -0,0 +1,61 @@
+import numpy as np
+from scipy.cluster.vq import kmeans2
+
+
+def top_n(scores, n, exclude=None):
+    '''
+    Returns the indices of the n highest scores in descending order, without sorting the whole array.
+    Indices in exclude are never returned.
+    '''
+    if exclude is not None and len(exclude) > 0:
+        scores = scores.copy()
+        scores[exclude] = -np.inf
+    n = min(n, len(scores))
+    if n <= 0:
+        return np.array([], dtype=int)
+    best = np.argpartition(-scores, n - 1)[:n]
+    best = best[np.argsort(-scores[best], kind='stable')]
+    return best[np.isfinite(scores[best])]
+
+
+class IVFIndex:
+    '''
+    Approximate maximum-inner-product index (inverted file).
+    Items are partitioned by k-means once; a query only scores the items of the n_probe lists
+    whose centroids have the largest inner product with it.
+    '''
+
+    def __init__(self, items, n_lists=None, n_probe=8, n_iter=20):
+        d = items.shape[0]
+        if n_lists is None:
+            n_lists = max(1, int(np.sqrt(d)))
+        self.items = items
+        self.n_probe = n_probe
+        self.centroids, labels = kmeans2(items, min(n_lists, d), iter=n_iter, minit='++')
+        self.order = np.argsort(labels, kind='stable')
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=len(self.centroids)))])
+
+    def _probe(self, query, n_probe):
+        lists = top_n(self.centroids @ query, n_probe)
+        return np.concatenate([self.order[self.offsets[l]:self.offsets[l + 1]] for l in lists])
+
+    def search(self, query, n, exclude=None, rescore=None):
+        '''
+        Returns (approximately) the n items with the largest inner product with query.
+        Indices in exclude are masked out before the selection.
+        rescore: if given, ranks the candidates by rescore(candidates) instead, for scores the inner product only
+        approximates
+        '''
+        excluded = np.zeros(len(self.items), dtype=bool)
+        if exclude is not None:
+            excluded[exclude] = True
+
+        n_probe = self.n_probe
+        while True:
+            candidates = self._probe(query, n_probe)
+            candidates = candidates[~excluded[candidates]]
+            if len(candidates) >= n or n_probe >= len(self.centroids):
+                break
+            n_probe *= 2
+        scores = self.items[candidates] @ query if rescore is None else rescore(candidates)
+        return candidates[top_n(scores, n)]
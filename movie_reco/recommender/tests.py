@@ -1,3 +1,109 @@
-from django.test import TestCase
+import numpy as np
+from django.test import SimpleTestCase, TestCase
 
-# Create your tests here.
+from accounts.models import User
+from movies.models import Movie
+from ratings.models import Rating
+from .catalog import Catalog
+from .matfac import FoldIn
+from .models import UserFactor
+from .user_factors import UserFactorStore
+
+
+def make_fold_in(n_items=20, K=4, seed=0):
+    rng = np.random.default_rng(seed)
+    return FoldIn(rng.normal(scale=0.5, size=(n_items, K)), rng.normal(scale=0.2, size=n_items), 3.5)
+
+
+class UpdateNormalEquationsTest(SimpleTestCase):
+    def setUp(self):
+        self.fold_in = make_fold_in()
+        self.ratings = {1: 4.0, 5: 2.5, 7: 3.0}
+
+    def assertMatchesFreshSolve(self, A_inv, b, ratings):
+        A_inv_ref, b_ref = self.fold_in.normal_equations(list(ratings), list(ratings.values()))
+        np.testing.assert_allclose(A_inv, A_inv_ref, atol=1e-12)
+        np.testing.assert_allclose(b, b_ref, atol=1e-12)
+        np.testing.assert_allclose(A_inv @ b, A_inv_ref @ b_ref, atol=1e-12)
+
+    def _start(self):
+        return self.fold_in.normal_equations(list(self.ratings), list(self.ratings.values()))
+
+    def test_add(self):
+        A_inv, b = self._start()
+        self.fold_in.update_normal_equations(A_inv, b, 9, None, 5.0)
+        self.assertMatchesFreshSolve(A_inv, b, {**self.ratings, 9: 5.0})
+
+    def test_remove(self):
+        A_inv, b = self._start()
+        self.fold_in.update_normal_equations(A_inv, b, 5, 2.5, None)
+        self.assertMatchesFreshSolve(A_inv, b, {1: 4.0, 7: 3.0})
+
+    def test_change_score(self):
+        A_inv, b = self._start()
+        self.fold_in.update_normal_equations(A_inv, b, 7, 3.0, 0.5)
+        self.assertMatchesFreshSolve(A_inv, b, {**self.ratings, 7: 0.5})
+
+    def test_many_updates(self):
+        rng = np.random.default_rng(1)
+        A_inv, b = self.fold_in.normal_equations([], [])
+        ratings = {}
+        for _ in range(1000):
+            item = int(rng.integers(0, 20))
+            if item in ratings and rng.random() < 0.3:
+                new_score = None
+            else:
+                new_score = float(rng.integers(1, 11)) / 2
+            self.fold_in.update_normal_equations(A_inv, b, item, ratings.get(item), new_score)
+            if new_score is None:
+                del ratings[item]
+            else:
+                ratings[item] = new_score
+        A_inv_ref, b_ref = self.fold_in.normal_equations(list(ratings), list(ratings.values()))
+        np.testing.assert_allclose(A_inv @ b, A_inv_ref @ b_ref, atol=1e-10)
+
+
+class UserFactorStoreTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(email="test@test.com", password="x", type=User.USER)
+        self.movies = [Movie.objects.create(tmdb_id=i, imdb_id=f"tt{i}", title=f"M{i}", title_kr=f"M{i}",
+                                            tagline="", overview="", overview_kr="", alt_poster="")
+                       for i in range(5)]
+        self.fold_in = make_fold_in(n_items=max(movie.id for movie in self.movies))
+        self.catalog = Catalog.dense(len(self.fold_in.V))
+        self.store = UserFactorStore(self.fold_in, self.catalog, 0.5, "v2")
+
+    def _rate(self, movie, score):
+        Rating.objects.create(user=self.user, movie=movie, score=score)
+
+    def _fresh_factor(self):
+        ratings = list(self.user.ratings.values_list('movie_id', 'score'))
+        rows = self.catalog.to_rows([movie_id for movie_id, _ in ratings])
+        A_inv, b = self.fold_in.normal_equations(rows, [float(score) for _, score in ratings], 0.5)
+        return A_inv @ b
+
+    def test_incremental_update(self):
+        self._rate(self.movies[0], 4.0)
+        self.store.apply(self.user, [(self.movies[0].id, None, 4.0)])
+        self._rate(self.movies[1], 2.0)
+        self.store.apply(self.user, [(self.movies[1].id, None, 2.0)])
+
+        self.assertEqual(UserFactor.objects.get(user=self.user).n_updates, 1)
+        np.testing.assert_allclose(self.store.get(self.user), self._fresh_factor(), atol=1e-12)
+
+    def test_rebuild_on_params_version_mismatch(self):
+        self._rate(self.movies[0], 4.0)
+        self._rate(self.movies[2], 1.5)
+        K = self.fold_in.K
+        UserFactor.objects.create(user=self.user, params_version="v1", a_inv=np.eye(K).tobytes(),
+                                  b=np.ones(K).tobytes(), n_updates=3)
+        self.assertIsNone(self.store.get(self.user))
+
+        # the stale state is discarded, not updated
+        self._rate(self.movies[3], 5.0)
+        self.store.apply(self.user, [(self.movies[3].id, None, 5.0)])
+
+        factor = UserFactor.objects.get(user=self.user)
+        self.assertEqual(factor.params_version, "v2")
+        self.assertEqual(factor.n_updates, 0)
+        np.testing.assert_allclose(self.store.get(self.user), self._fresh_factor(), atol=1e-12)
@@ -0,0 +1,71 @@
+import numpy as np
+
+from .encoding import fetch_ratings
+from .models import UserFactor
+
+
+class UserFactorStore:
+    """
+    Persisted fold-in state of every user who has rated something.
+    Each rating write is applied to it in O(K²) (see FoldIn.update_normal_equations), so that a recommendation
+    only needs the K×K product u = A⁻¹b instead of a fresh solve over all the user's ratings.
+    The state is rebuilt from the ratings when the serving parameters change, and every rebuild_every updates
+    to keep the round-off of the rank-one updates from piling up.
+    Ratings of movies unknown to the model don't contribute to the state.
+    """
+
+    def __init__(self, fold_in, catalog, lmbda, params_version, rebuild_every=200):
+        self.fold_in = fold_in
+        self.catalog = catalog
+        self.lmbda = lmbda
+        self.params_version = params_version
+        self.rebuild_every = rebuild_every
+
+    def _decode(self, factor):
+        K = self.fold_in.K
+        return np.frombuffer(factor.a_inv).reshape(K, K).copy(), np.frombuffer(factor.b).copy()
+
+    def _rebuild(self, user):
+        ratings = fetch_ratings(user.ratings.all(), 'movie_id')
+        rows, known = self.catalog.to_known_rows(ratings[:, 0].astype(int))
+        return self.fold_in.normal_equations(rows, ratings[known, 1], self.lmbda)
+
+    def get(self, user):
+        '''
+        Returns the user's factor, or None if there is no up-to-date state for the current parameters.
+        '''
+        factor = UserFactor.objects.filter(user=user, params_version=self.params_version).first()
+        if factor is None:
+            return None
+        A_inv, b = self._decode(factor)
+        return A_inv @ b
+
+    def apply(self, user, changes):
+        '''
+        changes: (movie id, old score, new score) of every rating the write touched, None meaning no rating.
+        Call it inside the transaction of the write, after the ratings are saved.
+        '''
+        factor = UserFactor.objects.select_for_update().filter(user=user).first()
+        if factor is None or factor.params_version != self.params_version or factor.n_updates >= self.rebuild_every:
+            # the rebuild reads the ratings as they are now, changes included
+            A_inv, b = self._rebuild(user)
+            n_updates = 0
+        else:
+            A_inv, b = self._decode(factor)
+            rows = self.catalog.to_rows([movie_id for movie_id, _, _ in changes])
+            for row, (_, old_score, new_score) in zip(rows, changes):
+                if row < 0:
+                    continue
+                self.fold_in.update_normal_equations(
+                    A_inv, b, row,
+                    None if old_score is None else float(old_score),
+                    None if new_score is None else float(new_score))
+            n_updates = factor.n_updates + len(changes)
+
+        if factor is None:
+            factor = UserFactor(user=user)
+        factor.params_version = self.params_version
+        factor.a_inv = A_inv.tobytes()
+        factor.b = b.tobytes()
+        factor.n_updates = n_updates
+        factor.save()
@@ -1,22 +1,40 @@
+from django.http import HttpResponse, HttpResponseForbidden
 from django.utils.decorators import method_decorator
-from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from accounts.decorators import login_required
+from accounts.decorators import user_required
 from accounts.utils import get_user_obj
+from recommender.cache import RECO_CACHE
+from recommender.metrics import RECO_METRICS
+from recommender.precompute import get_precomputed, render_reco_list
 from recommender.reco_interface import RECO_INTERFACE
+from recommender.reco_settings import METRICS_ALLOWED_IPS
 
 
-@method_decorator(login_required, name='dispatch')
+@method_decorator(user_required, name='dispatch')
 class RecoListAPI(APIView):
     def get(self, request, limit=100):
         user = get_user_obj(request)
-        reco_list = RECO_INTERFACE.get_recommendation(user, limit=min(100, limit))
+        limit = min(100, limit)
+        version = user.rating_version
+        # entries computed with other serving parameters (e.g. before train_mf or fold_in_movies) are misses
+        params_version = RECO_INTERFACE.params_version
+        json = RECO_CACHE.get(user.id, version, params_version, limit)
+        if json is not None:
+            RECO_METRICS.increment('cache_hits')
+            return Response(json)
+        RECO_METRICS.increment('cache_misses')
 
-        res_data = []
-        for label, items in reco_list.items():
-            entry = {"label": label, "items": items}
-            res_data.append(entry)
-        json = JSONRenderer().render(res_data)
+        json = get_precomputed(user, limit, params_version)
+        if json is not None:
+            RECO_METRICS.increment('precomputed_hits')
+        else:
+            json = render_reco_list(RECO_INTERFACE.get_recommendation(user, limit=limit))
+        RECO_CACHE.set(user.id, version, params_version, limit, json)
         return Response(json)
 
+
+def reco_metrics(request):
+    if request.META.get('REMOTE_ADDR') not in METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    return HttpResponse(RECO_METRICS.export(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -46,6 +46,41 @@ class BaseMovieCard {
         this.parentSelector = parentSelector
         this._getMovieData()
     }
+
+    render(parentSelector, data) {
+        // same as appendTo, with the data already fetched
+        this.parentSelector = parentSelector
+        this._successCallback(data)
+    }
+}
+
+function loadMovieCards(cards, parentSelector) {
+    // fetches the data of all cards in a single request, then renders them in order
+    if (cards.length == 0) {
+        return
+    }
+    $.ajax({
+        url: movieBaseUrl + 'batch/',
+        method: 'GET',
+        data: { ids: cards.map(card => card.movieId).join(',') },
+        dataType: 'json',
+        success: response => {
+            const movies = {}
+            JSON.parse(response).forEach(movie => {
+                movies[movie.id] = movie
+            })
+            cards.forEach(card => {
+                if (card.movieId in movies) {
+                    card.render(parentSelector, movies[card.movieId])
+                } else {
+                    card.errorCallback(response)
+                }
+            })
+        },
+        error: response => {
+            cards.forEach(card => card.errorCallback(response))
+        }
+    })
 }
 
 class StarMovieCard extends BaseMovieCard {
@@ -279,14 +314,26 @@ const ratingManager = {
             $('#ready-note').removeClass('d-none')
         }
     },
+    _pending: {},
+    _flushTimer: null,
+    _flushDelay: 500,
     _submitRating: function (movieId, rating) {
-        const method = rating == 0 ? 'DELETE' : 'POST'
+        // ratings given in quick succession are saved together
+        this._pending[movieId] = rating == 0 ? null : rating
+        clearTimeout(this._flushTimer)
+        this._flushTimer = setTimeout(() => this._flush(), this._flushDelay)
+    },
+    _flush: function () {
+        const ratings = this._takePending()
+        if (ratings.length == 0) {
+            return
+        }
         $.ajax({
             headers: { 'X-CSRFToken': csrftoken },
-            method: method,
-            url: evalBaseUrl + movieId + '/',
+            method: 'POST',
+            url: evalBaseUrl + 'batch/',
             contentType: 'application/json; charset=utf-8',
-            data: JSON.stringify({ score: rating }),
+            data: JSON.stringify({ ratings: ratings }),
             processData: true,
             dataType: 'json',
             success: response => {
@@ -294,6 +341,26 @@ const ratingManager = {
             }
         })
     },
+    _takePending: function () {
+        const ratings = Object.entries(this._pending).map(([movieId, score]) => ({ movie: Number(movieId), score: score }))
+        this._pending = {}
+        clearTimeout(this._flushTimer)
+        return ratings
+    },
+    _flushOnLeave: function () {
+        // the page may be gone before an ajax request completes; a keepalive fetch outlives it
+        const ratings = this._takePending()
+        if (ratings.length == 0) {
+            return
+        }
+        fetch(evalBaseUrl + 'batch/', {
+            method: 'POST',
+            keepalive: true,
+            credentials: 'same-origin',
+            headers: { 'X-CSRFToken': csrftoken, 'Content-Type': 'application/json; charset=utf-8' },
+            body: JSON.stringify({ ratings: ratings })
+        })
+    },
     applyStarRating: function (movieId, initScore, useAltColors) {
         const selector = this._selectorPrefix + movieId
         const color1 = useAltColors == true ? 'coral' : 'gold'
@@ -308,3 +375,5 @@ const ratingManager = {
         })
     }
 }
+
+window.addEventListener('pagehide', () => ratingManager._flushOnLeave())
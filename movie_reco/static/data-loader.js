@@ -85,6 +85,7 @@ class MovieCardLoaderV extends BaseDataLoader {
     }
 
     _deploySingleBatch(size = this.batchSize) {
+        const cards = [];
         for (let i = 0; i < size && this._queue.length > 0; i++) {
             const movieId = this._queue.shift(); // may use pop() instead
             const card = new this._cardClass(movieId);
@@ -92,8 +93,9 @@ class MovieCardLoaderV extends BaseDataLoader {
             card.errorCallback = () => {
                 this._deploySingleBatch(1);
             };
-            card.appendTo(this.cardContainerSelector);
+            cards.push(card);
         }
+        loadMovieCards(cards, this.cardContainerSelector);
     }
 }
 
@@ -110,6 +112,7 @@ class RatedMovieCardLoader extends MovieCardLoaderV {
     }
 
     _deploySingleBatch(size = this.batchSize) {
+        const cards = [];
         for (let i = 0; i < size && this._queue.length > 0; i++) {
             const rating = this._queue.shift(); // may use pop() instead
             const card = new this._cardClass(rating.movie, rating.score, true);
@@ -117,8 +120,9 @@ class RatedMovieCardLoader extends MovieCardLoaderV {
             card.errorCallback = () => {
                 this._deploySingleBatch(1);
             };
-            card.appendTo(this.cardContainerSelector);
+            cards.push(card);
         }
+        loadMovieCards(cards, this.cardContainerSelector);
     }
 }
 
@@ -150,6 +154,7 @@ class MovieCardLoaderH extends BaseDataLoader {
     }
 
     _deploySingleBatch(size = this.batchSize) {
+        const cards = [];
         for (let i = 0; i < size && this._queue.length > 0; i++) {
             const movieId = this._queue.shift(); // may use pop() instead
             const card = new this._cardClass(movieId);
@@ -157,8 +162,9 @@ class MovieCardLoaderH extends BaseDataLoader {
             card.errorCallback = () => {
                 this._deploySingleBatch(1);
             };
-            card.appendTo(this.cardContainerSelector);
+            cards.push(card);
         }
+        loadMovieCards(cards, this.cardContainerSelector);
     }
 }
 